@@ -0,0 +1,97 @@
+"""
+Compare the filtering speed (frames/sec) of the vpy file run by vspipe against
+the numpy filter engine on a video, and the screenlogs both write, e.g.
+python benchmarks/filter_throughput.py video.mkv -wdt 1344 -hgt 150 --block-size 64
+"""
+import argparse
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path, PurePath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import NumpyFilter, SubsFilter  # noqa: E402
+
+
+def run_vpy(args, output_dir):
+    params = [
+        f"Source={args.video}", f"OutputDir={output_dir}", f"width={args.width}", f"height={args.height}",
+        f"CropBox_y={args.cropbox_y}", f"CropBoxAlt_y={args.cropbox_alt_y}", f"Supersampling={args.supersampling}",
+        f"ExpandRatio={args.expand_ratio}", "Resampler=sinc", f"WhiteThresh={args.white_thresh}",
+        f"BlackThresh={args.black_thresh}", f"DetectionThresh={args.detection_thresh}",
+        f"NativeDetection={int(args.native_detection)}"
+    ]
+    command = [args.vapoursynth_path, "-c", "y4m", "-p"]
+    for param in params:
+        command += ["--arg", param]
+    command += [args.vpy, "-"]
+    print(f"vpy command: {shlex.join(command)}")
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+
+
+def run_numpy(args, output_dir):
+    numpy_filter = NumpyFilter.NumpyFilter(
+        args.width, args.height, args.cropbox_y, args.cropbox_alt_y, args.supersampling, args.expand_ratio,
+        "sinc", args.white_thresh, args.black_thresh, args.detection_thresh, args.native_detection,
+        args.decoder, args.ffmpeg_path, args.block_size
+    )
+    run, _ = numpy_filter.build(args.video, output_dir)
+    return sum(run.frames())
+
+
+def timed(label, func, frame_count=None):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    frame_count = frame_count or result
+    print(f"{label:<8} {frame_count:>7} frames in {elapsed:8.2f}s  {frame_count / elapsed:8.2f} frames/sec")
+    return result
+
+
+def compare(vpy_dir, numpy_dir):
+    for track in ("default", "alt"):
+        if not vpy_dir.joinpath(track, "SceneChanges.csv").is_file():
+            continue
+        vpy_rows = SubsFilter.read_screenlog_rows(vpy_dir.joinpath(track))
+        numpy_rows = SubsFilter.read_screenlog_rows(numpy_dir.joinpath(track))
+        differing = sorted(
+            n for n in vpy_rows.keys() | numpy_rows.keys()
+            if vpy_rows.get(n, (0, 0))[:2] != numpy_rows.get(n, (0, 0))[:2]
+        )
+        print(f"{track}: {len(vpy_rows)} vpy rows, {len(numpy_rows)} numpy rows, {len(differing)} frames differ"
+              + (f" {differing[:20]}" if differing else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filter throughput benchmark")
+    parser.add_argument("video", help="Video to filter")
+    parser.add_argument("-o", "--output", default=None, help="Directory of both outputs (default: a temporary one)")
+    parser.add_argument("-vpy", "--vpy", default=str(Path(__file__).resolve().parent.parent / "extract_subs_v1.vpy"))
+    parser.add_argument("-vps", "--vapoursynth-path", default="vspipe")
+    parser.add_argument("--skip-vpy", action="store_true", help="Only run the numpy filter engine")
+    parser.add_argument("-wdt", "--width", type=int, default=1344)
+    parser.add_argument("-hgt", "--height", type=int, default=150)
+    parser.add_argument("--cropbox-y", type=int, default=0)
+    parser.add_argument("--cropbox-alt-y", type=int, default=-1)
+    parser.add_argument("-ss", "--supersampling", type=int, default=-1)
+    parser.add_argument("-er", "--expand-ratio", type=int, default=1)
+    parser.add_argument("-wt", "--white-thresh", type=int, default=230)
+    parser.add_argument("-bt", "--black-thresh", type=int, default=80)
+    parser.add_argument("-dt", "--detection-thresh", type=float, default=0.03)
+    parser.add_argument("--native-detection", action="store_true")
+    parser.add_argument("--decoder", choices=NumpyFilter.DECODERS, default="ffmpeg")
+    parser.add_argument("--ffmpeg-path", default="ffmpeg")
+    parser.add_argument("--block-size", type=int, default=NumpyFilter.BLOCK_SIZE)
+    args = parser.parse_args()
+
+    output = Path(args.output or tempfile.mkdtemp(prefix="filter_throughput"))
+    print(f"Outputs in {output}")
+    frame_count = timed("numpy", lambda: run_numpy(args, output.joinpath("numpy")))
+    if not args.skip_vpy:
+        timed("vpy", lambda: run_vpy(args, output.joinpath("vpy")), frame_count)
+        video_name = PurePath(args.video).name
+        compare(output.joinpath("vpy", video_name), output.joinpath("numpy", video_name))
@@ -0,0 +1,80 @@
+"""
+Compare the OCR throughput (images/sec) of the per-image path against the
+list file batch and the mosaic paths on a directory of scene images, and
+the text every path reads, e.g.
+python benchmarks/ocr_throughput.py temp/video.mkv/default --mosaic 16
+
+With the fake engine, the three paths must read the same text.
+"""
+import argparse
+import multiprocessing
+import sys
+import time
+
+from multiprocessing.dummy import Pool as ThreadPool
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils import HocrParser, Mosaic, OCREngine  # noqa: E402
+
+
+def run(label, jobs, func, threads, image_count):
+    pool = ThreadPool(threads)
+    start = time.perf_counter()
+    results = pool.map(func, jobs)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    pool.join()
+    print(f"{label:<12} {image_count:>6} images in {elapsed:8.2f}s  {image_count / elapsed:8.2f} images/sec")
+    return results
+
+
+def chunked(items, size):
+    return [items[idx:idx + size] for idx in range(0, len(items), size)]
+
+
+def compare(label, images, texts, reference):
+    differing = [image for image, text, ref in zip(images, texts, reference) if text != ref]
+    print(f"{label:<12} {len(differing):>6} images read differently from per-image"
+          + (f" {[Path(image).name for image in differing[:10]]}" if differing else ""))
+    return not differing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCR throughput benchmark")
+    parser.add_argument("image_dir", help="Directory containing scene images (*.png)")
+    parser.add_argument("-l", "--lang", default="eng")
+    parser.add_argument("-e", "--engine", choices=OCREngine.ENGINES, default="auto")
+    parser.add_argument("-tss", "--tesseract-path", default="tesseract")
+    parser.add_argument("--fake-latency", type=float, default=0., help="Latency of the fake engine in seconds")
+    parser.add_argument("--replay", default=None, help="Recording replayed by the fake engine")
+    parser.add_argument("-T", "--threads", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-n", "--limit", type=int, default=0, help="Only use the first n images")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--mosaic", type=int, default=16)
+    args = parser.parse_args()
+
+    images = sorted(str(path) for path in Path(args.image_dir).glob("*.png"))
+    if args.limit:
+        images = images[:args.limit]
+    if not images:
+        sys.exit(f"No images found in {args.image_dir}")
+
+    engine = OCREngine.get_engine(args.engine, args.tesseract_path, fake_latency=args.fake_latency,
+                                  replay_path=args.replay)
+    print(f"Engine: {engine.name}, threads: {args.threads}")
+    per_image = run("per-image", images, lambda image: engine.recognize(image, args.lang), args.threads, len(images))
+    batches = run(f"batch x{args.batch_size}", chunked(images, args.batch_size),
+                  lambda chunk: engine.recognize_batch(chunk, args.lang), args.threads, len(images))
+    mosaics = run(f"mosaic x{args.mosaic}", chunked(images, args.mosaic),
+                  lambda chunk: Mosaic.recognize_mosaic(engine, chunk, args.lang), args.threads, len(images))
+    engine.close()
+
+    reference = [HocrParser.to_text(HocrParser.parse_hocr(html_content)) for html_content in per_image]
+    same = compare("batch", images, [
+        HocrParser.to_text(HocrParser.parse_hocr(html_content)) for batch in batches for html_content in batch
+    ], reference)
+    same &= compare("mosaic", images, [HocrParser.to_text(lines) for mosaic in mosaics for lines in mosaic], reference)
+    if engine.name == "fake" and not same:
+        sys.exit("The fake engine must read the same text with every OCR path")
@@ -1,30 +1,66 @@
 from argparse import RawTextHelpFormatter
 import configargparse
 import difflib
+import functools
 import json
 import logging
 import math
 import multiprocessing
 import os
-import pdb
+import queue
 import re
 import shlex
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
 
+import numpy as np
 from itertools import product
 from colorama import init, Fore, Style
 from multiprocessing.dummy import Pool as ThreadPool 
 from pathlib import Path, PurePath
 from spellchecker import SpellChecker
 from tqdm import tqdm
-from utils import Logger
+from utils import (
+    HocrParser, ImagePrep, IndexCache, JobPipeline, Logger, Mosaic, NumpyFilter, OCRCache, OCREngine, OCRScheduler,
+    Regions, SceneDedupe, SceneStream, SubsFilter
+)
+
 
 VERSION = "2.05"
 
 last_frame = 0
 video_fps = 0
 
+# Streaming mode: frames a scene change row may be logged late by, scenes
+# queued before an OCR batch starts and seconds between two screenlog reads
+STREAM_REORDER_WINDOW = 256
+STREAM_BATCH_SIZE = 32
+STREAM_POLL_INTERVAL = 0.5
+
+# Blank pixels kept around every text line OCRed on its own
+LINE_MARGIN = 4
+
+# Filter graph builder of the in-process filter engine
+subs_filter = None
+subs_filter_lock = threading.Lock()
+
+# Boxes filtered and OCRed on their own, the default and alt ones unless a regions file is given
+regions = None
+
+# Scenes the OCR gave up on, reported once every video is processed
+ocr_failures = []
+ocr_failures_lock = threading.Lock()
+
+# Text of the scenes kept by the "empty" failure policy, blank OCR results are dropped but not these
+FAILED_TEXT = "\x00"
+
+
+class OCRAborted(Exception):
+    """An image still failing after the retries, with the "abort" failure policy."""
+
 # TODO: Use subedit
 def which(*executables):
     return next(iter(
@@ -174,32 +210,260 @@ def extreme_try_subs_without_char(sub_data, chars_to_try_to_replace, language, w
     return sub_data
 
 
+def ocr_result(lines):
+    # Text of the subtitle and compact hOCR of its lines, as stored in the OCR cache
+    return HocrParser.to_text(lines), HocrParser.to_hocr(lines)
+
+
 def new_ocr_image(arg_tuple):
     scene, language, pbar = arg_tuple
-    img_path = scene[2]
-    result_base = PurePath(img_path).suffix[0]
-    
-    tess_cmd = [args.tesseract_path, img_path, "stdout", "-l", language, "--psm", "6", "hocr"]
-    html_content = subprocess.check_output(
-        tess_cmd,
-        stderr=subprocess.DEVNULL
-    ).decode('utf-8')
-        
-    # Convert to text only
-    text = re.sub(r"<(?!/?em)[^>]+>", "", html_content)
-    text = text.strip().replace(
-        "</em> <em>", " ").replace(
-        "&#39;", "'").replace(
-        "&quot;", "\"").replace(
-        "&amp;", "&").replace(
-        "&gt;", ">").replace(
-        "&lt;", "<")
-    text = re.sub(r"<(/?)em>", "<\\1i>", text)
-    text = '\n'.join([x.strip() for x in text.splitlines() if x.strip()])
-    text = re.sub(r"</i>(?:\r\n|\n)<i>", "\n", text)
+    image = scene[2]
+
+    if isinstance(image, np.ndarray):
+        html_content = ocr_engine.recognize_array(image, language)
+    else:
+        html_content = ocr_engine.recognize(image, language)
     
     pbar.update(1)
-    return text, (scene[0], scene[1])
+    return [ocr_result(HocrParser.parse_hocr(html_content))]
+
+
+def new_ocr_batch(arg_tuple):
+    scenes, language, pbar = arg_tuple
+
+    html_contents = ocr_engine.recognize_batch([scene[2] for scene in scenes], language)
+    results = [ocr_result(HocrParser.parse_hocr(html_content)) for html_content in html_contents]
+
+    pbar.update(len(scenes))
+    return results
+
+
+def new_ocr_mosaic(arg_tuple):
+    scenes, language, pbar = arg_tuple
+
+    image_lines = Mosaic.recognize_mosaic(ocr_engine, [scene[2] for scene in scenes], language)
+    results = [ocr_result(lines) for lines in image_lines]
+
+    pbar.update(len(scenes))
+    return results
+
+
+def crop_settings():
+    # Cropping changes the OCR result, the cache keys only carry it when enabled
+    return ("crop", args.ocr_crop_margin) if args.ocr_crop_margin >= 0 else ()
+
+
+def ocr_with_retries(image, language, attempts, psm=None, error=None):
+    for attempt in range(attempts):
+        try:
+            if isinstance(image, np.ndarray):
+                return ocr_engine.recognize_array(image, language, psm)
+            return ocr_engine.recognize(image, language, psm)
+        except Exception as e:
+            log.debug(f" + OCR - Attempt {attempt + 1} of {attempts} failed: {e}")
+            error = e
+    raise error
+
+
+def guarded_ocr_job(worker, arg_tuple):
+    job, language, pbar = arg_tuple
+    try:
+        return worker(arg_tuple)
+    except Exception as e:
+        error = e
+    # A failed batch or mosaic is OCRed again image by image, a failed image is retried
+    chunk = isinstance(job, list)
+    scenes = job if chunk else [job]
+    attempts = args.ocr_retries + 1 if chunk else args.ocr_retries
+    log.debug(f" + OCR - Job of {len(scenes)} images failed: {error}")
+    results = []
+    for scene in scenes:
+        try:
+            html_content = ocr_with_retries(scene[2], language, attempts, args.ocr_fallback_psm, error)
+            results.append(ocr_result(HocrParser.parse_hocr(html_content)))
+        except Exception as e:
+            # The failure policy is applied once the scenes are all OCRed
+            results.append(e)
+        pbar.update(1)
+    return results
+
+
+def guarded_ocr_line(arg_tuple):
+    strip, language, pbar = arg_tuple
+    try:
+        return new_ocr_line(arg_tuple)
+    except Exception as e:
+        error = e
+    try:
+        result = ocr_result(HocrParser.parse_hocr(
+            ocr_with_retries(strip, language, args.ocr_retries, OCREngine.LINE_PSM, error)
+        ))
+    except Exception as e:
+        result = e
+    pbar.update(1)
+    return result
+
+
+def split_scene_lines(scene):
+    image = ImagePrep.read_gray(scene[2])
+    strips = []
+    for top, bottom in ImagePrep.split_lines(image):
+        # Cropped to its text, the same line gives the same strip wherever it is
+        strip, (dx, dy) = ImagePrep.crop_to_text(image[top:bottom], LINE_MARGIN)
+        strips.append((strip, (dx, top + dy)))
+    return strips
+
+
+def new_ocr_line(arg_tuple):
+    strip, language, pbar = arg_tuple
+
+    html_content = ocr_engine.recognize_array(strip, language, OCREngine.LINE_PSM)
+
+    pbar.update(1)
+    return ocr_result(HocrParser.parse_hocr(html_content))
+
+
+def ocr_scene_lines(scenes, pbar):
+    pool = ThreadPool(args.threads)
+    scene_strips = pool.map(split_scene_lines, scenes)
+    strip_keys = pool.map(line_cache_key, [strip for strips in scene_strips for strip, _ in strips])
+    pool.close()
+    pool.join()
+
+    # A line often stays on screen while the other one changes, identical strips are OCRed once
+    strips = dict(zip(strip_keys, [strip for strips in scene_strips for strip, _ in strips]))
+    line_results = {}
+    if ocr_cache is not None:
+        for key in strips:
+            result = ocr_cache.get(key)
+            if result is not None:
+                line_results[key] = result
+    todo = [key for key in strips if key not in line_results]
+    log.debug(f" + Lines - {len(strip_keys)} lines, {len(strips)} distinct, {len(todo)} to OCR")
+
+    # The progress bar counts lines from now on
+    pbar.total += len(todo) - len(scenes)
+    pbar.refresh()
+    new_results = ocr_scheduler.run(guarded_ocr_line, [(strips[key], args.lang, pbar) for key in todo])
+    for key, result in zip(todo, new_results):
+        line_results[key] = result
+        if ocr_cache is not None and not isinstance(result, Exception):
+            ocr_cache.put(key, *result)
+
+    results = []
+    keys = iter(strip_keys)
+    for strips in scene_strips:
+        lines = []
+        error = None
+        for _, offset in strips:
+            result = line_results[next(keys)]
+            if isinstance(result, Exception):
+                error = result
+            else:
+                lines += HocrParser.shift(HocrParser.parse_hocr(result[1]), *offset)
+        # A scene with a failed line failed as a whole
+        results.append(error or ocr_result(lines))
+    return results
+
+
+def ocr_mode_settings():
+    # Mosaic results are split back by line position, and line OCR uses another psm, so they are cached apart
+    if args.ocr_lines:
+        return ("lines", OCREngine.LINE_PSM)
+    if args.ocr_mosaic > 1:
+        return ("mosaic", args.ocr_mosaic)
+    if args.ocr_batch_size > 1:
+        return ("batch",)
+    return ()
+
+
+def scene_cache_key(scene):
+    settings = crop_settings() + ocr_mode_settings()
+    return OCRCache.image_file_key(scene[2], args.lang, ocr_engine.psm, ocr_engine.version(), *settings)
+
+
+def line_cache_key(strip):
+    return OCRCache.image_key(strip, args.lang, OCREngine.LINE_PSM, ocr_engine.version())
+
+
+def reocr_cache_key(scene):
+    return OCRCache.image_file_key(
+        scene[2], args.lang, args.reocr_psm or ocr_engine.psm, ocr_engine.version(), "upscale", args.reocr_upscale,
+        *crop_settings()
+    )
+
+
+def crop_scene(arg_tuple):
+    idx, scene, crop_dir = arg_tuple
+    image, offset = ImagePrep.crop_to_text(ImagePrep.read_gray(scene[2]), args.ocr_crop_margin)
+    if image is None:
+        return None, offset
+    if crop_dir is None:
+        # Kept in memory, the engine gets the pixels without another PNG round trip
+        return (scene[0], scene[1], image), offset
+    # default and alt images share their names, the index keeps them apart
+    crop_path = os.path.join(crop_dir, f"{idx}.png")
+    ImagePrep.write_image(crop_path, image)
+    return (scene[0], scene[1], crop_path), offset
+
+
+def shift_result(result, dx, dy):
+    return ocr_result(HocrParser.shift(HocrParser.parse_hocr(result[1]), dx, dy))
+
+
+def word_ratio(lines):
+    words = [
+        word for line in lines for hocr_word in line.words for word in re.findall(r"\w+", hocr_word.text, re.UNICODE)
+    ]
+    if not words:
+        return -1.
+    return sum(1 for word in words if is_word(word)) / len(words)
+
+
+def needs_reocr(lines):
+    if not lines:
+        return False
+    confidence = HocrParser.mean_confidence(lines)
+    if 0 <= confidence < args.reocr_confidence:
+        return True
+    if args.reocr_word_ratio >= 0 and 0 <= word_ratio(lines) < args.reocr_word_ratio:
+        return True
+    return False
+
+
+def reocr_score(lines):
+    # Sum of the enabled quality measures, both scaled to [0, 1]
+    score = 0.
+    if args.reocr_confidence >= 0:
+        score += HocrParser.mean_confidence(lines) / 100.
+    if args.reocr_word_ratio >= 0:
+        score += word_ratio(lines)
+    return score
+
+
+def guarded_reocr_image(arg_tuple):
+    # The first pass result is kept when the re-OCR fails
+    try:
+        return new_reocr_image(arg_tuple)
+    except Exception as e:
+        log.debug(f" + Re-OCR - Failed on {arg_tuple[0][2]}: {e}")
+        return None
+
+
+def new_reocr_image(arg_tuple):
+    scene, language, pbar = arg_tuple
+    image = ImagePrep.read_gray(scene[2])
+    offset = (0, 0)
+    if args.ocr_crop_margin >= 0:
+        image, offset = ImagePrep.crop_to_text(image, args.ocr_crop_margin)
+    image = ImagePrep.upscale(image, args.reocr_upscale)
+
+    html_content = ocr_engine.recognize_array(image, language, args.reocr_psm)
+    lines = HocrParser.scale(HocrParser.parse_hocr(html_content), 1. / args.reocr_upscale)
+    lines = HocrParser.shift(lines, *offset)
+
+    pbar.update(1)
+    return ocr_result(lines)
 
 
 # Fix time issues by someonelike-u
@@ -258,10 +522,10 @@ def convert_to_srt(sub_data, mp4_path):
                     sub_data[idx][0],
                     (sub_data[idx][1][0], bound1)
                 )
-                sub_data[idx + 1] = ("{}\n{}".format(
-                    (alt_line, def_line),
+                sub_data[idx + 1] = (
+                    "{}\n{}".format(alt_line, def_line),
                     (bound1, bound2)
-                ))
+                )
             elif int(sub_data[idx][1][1]) > int(sub_data[idx + 1][1][1]):
                 # Case where first line longer than the second
                 bound1 = sub_data[idx + 1][1][0]
@@ -274,24 +538,24 @@ def convert_to_srt(sub_data, mp4_path):
                     sub_data[idx][0],
                     (sub_data[idx][1][0], bound1)
                 )
-                sub_data[idx + 1] = ("{}\n{}".format(
-                    (alt_line, def_line),
+                sub_data[idx + 1] = (
+                    "{}\n{}".format(alt_line, def_line),
                     (bound1, bound2)
-                ))
+                )
             else:
                 # Case where the lines end at the same time
                 sub_data[idx] = (
                     sub_data[idx][0],
                     (sub_data[idx][1][0], sub_data[idx + 1][1][0])
                 )
-                sub_data[idx + 1] = ("{}\n{}".format(
-                    (alt_line, def_line),
+                sub_data[idx + 1] = (
+                    "{}\n{}".format(alt_line, def_line),
                     (sub_data[idx + 1][1][0], sub_data[idx + 1][1][1])
-                ))
+                )
             idx += 1
         idx += 1
 
-    with open(f"{PurePath(mp4_path).suffix[0]}.srt", "w", encoding="utf8") as ofile:
+    with open(PurePath(mp4_path).with_suffix(".srt"), "w", encoding="utf8") as ofile:
         idx = 1
         for data in sub_data:
             if len(data[0]) > 0:
@@ -300,7 +564,7 @@ def convert_to_srt(sub_data, mp4_path):
                     sec_to_time(float(data[1][0]) / video_fps),
                     sec_to_time((float(data[1][1]) / video_fps)))
                 ).replace('.', ',')
-                text += data[0]
+                text += data[0].replace(FAILED_TEXT, "")
                 text += "\n\n"
                 ofile.write(text)
                 idx += 1
@@ -308,7 +572,7 @@ def convert_to_srt(sub_data, mp4_path):
 
 # TODO: Use subtitleedit for converting to ass
 def convert_to_ass(sub_data, mp4_path):
-    with open(f"{PurePath(mp4_path).suffix[0]}.ass", "w", encoding="utf8") as ofile:
+    with open(PurePath(mp4_path).with_suffix(".ass"), "w", encoding="utf8") as ofile:
         ofile.write(u'[Script Info]\nScriptType: v4.00+\nWrapStyle: 0\n'
                     u'PlayResX: 1920\nPlayResY: 1080\n\n')
         ofile.write(u'[V4+ Styles]\nFormat: Name, Fontname, Fontsize, PrimaryColour,'
@@ -324,6 +588,7 @@ def convert_to_ass(sub_data, mp4_path):
                 starttime = sec_to_time(float(data[1][0]) / video_fps)
                 endtime = sec_to_time((float(data[1][1]) / video_fps))
                 text = data[0].replace(
+                    FAILED_TEXT, "").replace(
                     "\n", " ").replace(
                     "<i>", "{\\i1}").replace(
                     "</i>", "{\\i0}").replace(
@@ -437,11 +702,47 @@ def check_sub_data(sub_data):
     return sub_data
 
 
-def new_filter_only(path, outputdir):
-    log.info(f" + Starting mode filter for file {path}")
-    
+def get_subs_filter():
+    # VapourSynth is imported and the graph parameters are set once, graphs are then built per video
+    global subs_filter
+    with subs_filter_lock:
+        if subs_filter is None and args.filter_engine == "numpy":
+            subs_filter = NumpyFilter.NumpyFilter(
+                args.width, args.height, args.CropBox_y, args.CropBoxAlt_y, args.Supersampling,
+                args.ExpandRatio, args.Resampler, int(args.WhiteThresh), int(args.BlackThresh),
+                float(args.DetectionThresh), args.filter_native_detection, args.filter_decoder, args.ffmpeg_path,
+                regions=regions
+            )
+        elif subs_filter is None:
+            import vapoursynth as vs
+            subs_filter = SubsFilter.SubsFilter(
+                vs.core, args.width, args.height, args.CropBox_y, args.CropBoxAlt_y, args.Supersampling,
+                args.ExpandRatio, args.Resampler, int(args.WhiteThresh), int(args.BlackThresh),
+                float(args.DetectionThresh), not args.filter_full_output,
+                args.filter_native_detection, regions
+            )
+    return subs_filter
+
+
+def begin_filter(path):
+    # Index of the video in the index cache, None lets ffms2 write it next to the video
+    if index_cache is None:
+        return None
+    index_path = index_cache.acquire(path)
+    log.debug(f" + ffms2 index {'reused' if index_path.is_file() else 'created'}: {index_path}")
+    return index_path
+
+
+def start_filter(path, outputdir, index_path=None, chunk_count=1, chunk_id=0, spans=None):
+    # Sampled detection requests frames out of order, which vspipe cannot do
+    if args.filter_engine != "vspipe" or args.filter_sample_duration > 0:
+        log.debug(f" + Filtering {path} in-process")
+        return SubsFilter.FilterRun(
+            get_subs_filter(), str(path), outputdir, sample_duration=args.filter_sample_duration / 1000,
+            chunk_count=chunk_count, chunk_id=chunk_id, index_path=index_path and str(index_path), spans=spans
+        )
     params = " --arg ".join([
-        "Source=\"" + path.replace("\\", "\\\\") + "\"",
+        "Source=\"" + str(path).replace("\\", "\\\\") + "\"",
         "OutputDir=" + outputdir,
         "width=" + str(args.width),
         "height=" + str(args.height),
@@ -452,123 +753,365 @@ def new_filter_only(path, outputdir):
         "Resampler=" + str(args.Resampler),
         "WhiteThresh=" + str(args.WhiteThresh),
         "BlackThresh=" + str(args.BlackThresh),
-        "DetectionThresh=" + str(args.DetectionThresh)
+        "DetectionThresh=" + str(args.DetectionThresh),
+        "PropsOnly=" + ("0" if args.filter_full_output else "1"),
+        "NativeDetection=" + ("1" if args.filter_native_detection else "0"),
+        "ChunkCount=" + str(chunk_count),
+        "ChunkId=" + str(chunk_id),
+        "IndexFile=\"" + str(index_path or "").replace("\\", "\\\\") + "\"",
+        "ChunkSpans=" + (SubsFilter.format_spans(spans) if spans else ""),
+        "RegionsFile=\"" + str(args.regions or "").replace("\\", "\\\\") + "\""
         ])
     
     vscmd = f"'{args.vapoursynth_path}' -c y4m -p --arg " + params + f" '{args.vpy}' -"
     log.debug(f" + Command used: {vscmd}")
     
-    with open(os.devnull, 'w') as fnull:
-        subprocess.call(shlex.split(vscmd), stdout=fnull)
+    return subprocess.Popen(shlex.split(vscmd), stdout=subprocess.DEVNULL)
+
+
+def end_filter(path, index_path=None):
+    if index_path is not None:
+        index_cache.release(index_path)
+    elif Path(str(path) + ".ffindex").is_file():
+        Path(str(path) + ".ffindex").unlink(missing_ok=True)
+
+
+def filter_chunks(path, outputdir, index_path, groups=None):
+    # groups holds the spans of frames filtered by every chunk, when they are not an equal split of the video
+    chunk_count = len(groups) if groups else args.filter_chunks
+    start = time.perf_counter()
+    video_dir = Path(outputdir).joinpath(PurePath(path).name)
+    runs = [start_filter(path, outputdir, index_path, chunk_count, 0, groups and groups[0])]
+    if groups is None and (index_path is None or not index_path.is_file()):
+        # The other chunks start once the first one has opened its screenlog, so the video is indexed only once
+        journal = video_dir.joinpath(regions[0].name, "chunk0", "SceneChanges.jsonl")
+        while runs[0].poll() is None and not journal.is_file():
+            time.sleep(STREAM_POLL_INTERVAL)
+    runs += [
+        start_filter(path, outputdir, index_path, chunk_count, chunk_id, groups and groups[chunk_id])
+        for chunk_id in range(1, chunk_count)
+    ]
+    if any([run.wait() != 0 for run in runs]):
+        log.error(f" - Filtering a chunk of {path} failed, its screenlogs are not merged")
+        return
     
-    if Path(path + ".ffindex").is_file():
-        Path(path + ".ffindex").unlink(missing_ok=True)
+    for track in [region.name for region in regions]:
+        track_dir = video_dir.joinpath(track)
+        if not track_dir.joinpath("chunk0").is_dir():
+            continue
+        mismatches = SubsFilter.merge_chunk_logs(track_dir, chunk_count)
+        if mismatches:
+            log.warning(f" - Chunks of the {track} screenlog disagree on frames {mismatches}")
+    log.info(f" + Filtered {path} in {chunk_count} chunks, {time.perf_counter() - start:.2f} sec")
 
 
-def get_scenes_from_scene_data(scene_data, last_frame, base_dir):
-    scene_bounds = []
-    scene_bounds = re.findall(
-        r"(\d+),(\d),(\d),\"([^\"]*)\"", "\n".join(scene_data.split("\n")[1:])
+def filter_presence(path, outputdir, index_path):
+    start = time.perf_counter()
+    ranges, frame_count, _ = get_subs_filter().presence_ranges(str(path), index_path and str(index_path))
+    spans = SubsFilter.presence_spans(ranges, frame_count)
+    prepass_time = time.perf_counter() - start
+    kept = sum(span.filter_end - span.filter_start for span in spans)
+    log.info(
+        f" + Presence pre-pass: {kept} of {frame_count} frames to filter in {len(spans)} ranges,"
+        f" {prepass_time:.2f} sec"
     )
-    scene_bounds = sorted(scene_bounds, key=lambda scene_bound: scene_bound[0])
-    
-    scenes = []
-    start_frame = None
-    start_img_path = None
-    for idx, scene_bond in enumerate(scene_bounds):
-        frame = int(scene_bond[0])
-        is_start = int(scene_bond[1])
-        is_end = int(scene_bond[2])
-        img_path = scene_bond[3]
-        img_path = os.path.join(base_dir, img_path)
-        if idx == 0 and not is_start and is_end:
-            # Case where scenechange missed first scene ??? (has happened)
-            pass
-        elif is_start and is_end: 
-            # Case where the scene is one frame long (should not happen too often)
-            scenes.append((frame, frame, img_path))
-        elif is_start:
-            start_frame = frame
-            start_img_path = img_path
-        elif is_end and start_frame and start_img_path:
-            scenes.append((start_frame, frame, start_img_path))
-            start_frame = None
-            start_img_path = None
+    
+    if spans:
+        filter_chunks(path, outputdir, index_path, SubsFilter.split_spans(spans, args.filter_chunks))
+        filter_time = time.perf_counter() - start - prepass_time
+        # Skipped frames are assumed to cost as much to filter as the kept ones, spans always keep frames
+        saved = filter_time * (frame_count - kept) / max(kept, 1) - prepass_time
+        log.info(
+            f" + Presence pre-pass skipped {frame_count - kept} frames, "
+            + (f"saving about {saved:.2f} sec" if saved >= 0 else f"costing about {-saved:.2f} sec more than it saved")
+        )
+    else:
+        # The pre-pass may miss text it does not recognize, it never leaves a video without subtitles
+        log.warning(f" - Presence pre-pass found no text in {path}, filtering every frame")
+        if args.filter_chunks > 1:
+            filter_chunks(path, outputdir, index_path)
         else:
-            # Should not get here often, but still
-            pass
-    if start_frame and start_img_path:
-        scenes.append((start_frame, last_frame, start_img_path))
-    return scenes
+            start_filter(path, outputdir, index_path).wait()
+    
+    if args.filter_presence_verify:
+        verify_presence(path, outputdir, index_path, time.perf_counter() - start)
+
+
+def verify_presence(path, outputdir, index_path, elapsed):
+    verify_dir = Path(outputdir).joinpath(PurePath(path).name, "presence_verify")
+    start = time.perf_counter()
+    start_filter(path, str(verify_dir), index_path).wait()
+    full_time = time.perf_counter() - start
+    
+    for track in [region.name for region in regions]:
+        track_dir = Path(outputdir).joinpath(PurePath(path).name, track)
+        if not track_dir.joinpath("SceneChanges.csv").is_file():
+            continue
+        rows = SubsFilter.read_screenlog_rows(track_dir)
+        full_rows = SubsFilter.read_screenlog_rows(verify_dir.joinpath(PurePath(path).name, track))
+        differences = sorted(
+            n for n in set(rows) | set(full_rows) if rows.get(n, ())[:2] != full_rows.get(n, ())[:2]
+        )
+        if differences:
+            log.warning(f" - Presence pre-pass: the {track} screenlog differs from a full run on frames {differences}")
+        else:
+            log.info(f" + Presence pre-pass: the {track} screenlog matches a full run")
+    log.info(f" + Presence pre-pass: filtered in {elapsed:.2f} sec, {full_time:.2f} sec for a full run")
+    shutil.rmtree(verify_dir, ignore_errors=True)
+
+
+def new_filter_only(path, outputdir):
+    log.info(f" + Starting mode filter for file {path}")
+    
+    index_path = begin_filter(path)
+    try:
+        if args.filter_presence:
+            filter_presence(path, outputdir, index_path)
+        elif args.filter_chunks > 1:
+            filter_chunks(path, outputdir, index_path)
+        else:
+            start_filter(path, outputdir, index_path).wait()
+    finally:
+        end_filter(path, index_path)
+
+
+def get_scenes_from_scene_data(scene_data, last_frame, base_dir):
+    builder = SceneStream.SceneBuilder(base_dir)
+    builder.feed_text("\n".join(scene_data.split("\n")[1:]))
+    return builder.finish(last_frame)
 
 
 def ocr_scenes(scenes):
     log.info(" + OCRing images...")
-    pool = ThreadPool(args.threads)
+    results = [None] * len(scenes)
+    keys = []
+    if ocr_cache is not None:
+        pool = ThreadPool(args.threads)
+        keys = pool.map(scene_cache_key, scenes)
+        pool.close()
+        pool.join()
+        for idx, key in enumerate(keys):
+            results[idx] = ocr_cache.get(key)
+    todo = [idx for idx in range(len(scenes)) if results[idx] is None]
+    todo_scenes = [scenes[idx] for idx in todo]
+    misses = len(todo)
+
+    offsets = {}
+    crop_dir = None
+    if args.ocr_crop_margin >= 0 and todo:
+        # OCR the images cropped to their text, blank images need no OCR at all
+        if worker_needs_files():
+            crop_dir = tempfile.mkdtemp(dir=args.workdir)
+        pool = ThreadPool(args.threads)
+        cropped = pool.map(crop_scene, [(idx, scenes[idx], crop_dir) for idx in todo])
+        pool.close()
+        pool.join()
+        for idx, (scene, offset) in zip(todo, cropped):
+            if scene is None:
+                results[idx] = ("", "")
+            else:
+                offsets[idx] = offset
+        log.info(f" + Crop - {len(todo) - len(offsets)} blank images skipped")
+        todo_scenes = [scene for scene, _ in cropped if scene is not None]
+        todo = [idx for idx in todo if idx in offsets]
+
     pbar = tqdm(total=len(scenes), mininterval=1)
-    scenes = pool.map(new_ocr_image, [(scene, args.lang, pbar) for scene in scenes])
+    pbar.update(len(scenes) - len(todo))
+    try:
+        new_results = ocr_scene_images(todo_scenes, pbar)
+    finally:
+        if crop_dir is not None:
+            shutil.rmtree(crop_dir)
+    failed = set()
+    for idx, result in zip(todo, new_results):
+        if isinstance(result, Exception):
+            scene = scenes[idx]
+            with ocr_failures_lock:
+                ocr_failures.append(f"{scene[2]} (frames {scene[0]}-{scene[1]}): {result}")
+            if args.ocr_failure == "abort":
+                pbar.close()
+                raise OCRAborted(f"OCR gave up on {scene[2]} (frames {scene[0]}-{scene[1]}): {result}")
+            failed.add(idx)
+            results[idx] = ("", "")
+            continue
+        if idx in offsets:
+            result = shift_result(result, *offsets[idx])
+        results[idx] = result
+        if ocr_cache is not None:
+            ocr_cache.put(keys[idx], *result)
+
+    pbar.close()
+    if ocr_cache is not None:
+        log.info(f" + OCR cache: {len(scenes) - misses} hits, {misses} misses")
+    if failed:
+        log.warning(f" - OCR failed on {len(failed)} images")
+    if args.reocr_confidence >= 0 or args.reocr_word_ratio >= 0:
+        results = reocr_scenes(scenes, results)
+    # Skipped scenes get no text at all and are left out of the subtitles, empty ones keep a cue with no text
+    failed_text = None if args.ocr_failure == "skip" else FAILED_TEXT
+    return [
+        (failed_text if idx in failed else text, (scene[0], scene[1]))
+        for idx, ((text, _), scene) in enumerate(zip(results, scenes))
+    ]
+
+
+def worker_needs_files():
+    # Batches are given to tesseract as a list of image files
+    return args.ocr_batch_size > 1 and args.ocr_mosaic <= 1 and not args.ocr_lines
+
+
+def ocr_scene_images(scenes, pbar):
+    if args.ocr_lines:
+        return ocr_scene_lines(scenes, pbar)
+    if args.ocr_mosaic > 1:
+        chunk_size = args.ocr_mosaic
+        worker = new_ocr_mosaic
+    elif args.ocr_batch_size > 1:
+        chunk_size = args.ocr_batch_size
+        worker = new_ocr_batch
+    else:
+        chunk_size = 1
+        worker = new_ocr_image
+    if chunk_size > 1:
+        jobs = [scenes[idx:idx + chunk_size] for idx in range(0, len(scenes), chunk_size)]
+    else:
+        jobs = scenes
+    chunks = ocr_scheduler.run(
+        functools.partial(guarded_ocr_job, worker),
+        [(job, args.lang, pbar) for job in jobs],
+        [len(job) for job in jobs] if chunk_size > 1 else None
+    )
+    return [result for chunk in chunks for result in chunk]
+
+
+def reocr_scenes(scenes, results):
+    todo = [idx for idx, (_, hocr) in enumerate(results) if needs_reocr(HocrParser.parse_hocr(hocr))]
+    if not todo:
+        return results
+    log.info(f" + Re-OCRing {len(todo)} low confidence images...")
+    reocr_results = [None] * len(todo)
+    keys = []
+    if ocr_cache is not None:
+        keys = [reocr_cache_key(scenes[idx]) for idx in todo]
+        reocr_results = [ocr_cache.get(key) for key in keys]
+    missing = [pos for pos in range(len(todo)) if reocr_results[pos] is None]
+
+    pbar = tqdm(total=len(todo), mininterval=1)
+    pbar.update(len(todo) - len(missing))
+    new_results = ocr_scheduler.run(guarded_reocr_image, [(scenes[todo[pos]], args.lang, pbar) for pos in missing])
+    for pos, result in zip(missing, new_results):
+        reocr_results[pos] = result
+        if ocr_cache is not None and result is not None:
+            ocr_cache.put(keys[pos], *result)
+    pbar.close()
+
+    # Keep the second pass only where it scores better than the first one
+    results = list(results)
+    kept = 0
+    for idx, result in zip(todo, reocr_results):
+        if result is not None and reocr_score(HocrParser.parse_hocr(result[1])) > reocr_score(HocrParser.parse_hocr(results[idx][1])):
+            results[idx] = result
+            kept += 1
+    log.info(f" + Re-OCR - Kept the second pass for {kept} of {len(todo)} images")
+    return results
+
+
+def ocr_unique_scenes(scenes):
+    if args.dedupe_threshold < 0 or len(scenes) < 2:
+        return ocr_scenes(scenes)
+    pool = ThreadPool(args.threads)
+    hashes = pool.map(SceneDedupe.scene_hash, [scene[2] for scene in scenes])
     pool.close()
     pool.join()
-    pbar.close()
-    return scenes
+    groups = SceneDedupe.group_hashes(hashes, args.dedupe_threshold)
+    representatives = sorted(set(groups))
+    log.info(f" + Dedupe - {len(scenes)} scenes, {len(representatives)} distinct images")
+    
+    # OCR one scene per group and give its text to every scene of the group
+    texts = dict(zip(
+        representatives,
+        [text for text, _ in ocr_scenes([scenes[idx] for idx in representatives])]
+    ))
+    return [(texts[group], (scene[0], scene[1])) for group, scene in zip(groups, scenes)]
 
 
-def ocr_one_screenlog(screenlog_dir):
-    log.info(f" + OCR - Processing directory {screenlog_dir}")
+def read_screenlog(screenlog_dir):
+    log.info(f" + OCR - Reading directory {screenlog_dir}")
 
     with open(Path(screenlog_dir).joinpath("SceneChanges.csv"), "r") as ifile:
         video_data, scene_data = ifile.read().split("[Scene Informations]\n", 1)
-        
-    global video_fps
-    global last_frame
     
+    # Several videos can be OCRed at once, so the framerate is returned instead of kept in video_fps
     video_data_match = re.findall(
         r"\[Video Informations\]\nfps=(\d+\.\d+)\nframe_count=(\d+)",
         video_data
     )[0]
-    video_fps = float(video_data_match[0])
+    fps = float(video_data_match[0])
     last_frame = int(video_data_match[1]) - 1
     
-    log.debug(f" + Video framerate is: {str(video_fps)}")
+    log.debug(f" + Video framerate is: {str(fps)}")
     log.debug(f" + Last frame is: {last_frame}")
     
-    scenes = get_scenes_from_scene_data(scene_data, last_frame, screenlog_dir)
-    return ocr_scenes(scenes)
+    return get_scenes_from_scene_data(scene_data, last_frame, screenlog_dir), fps
 
 
-def new_ocr_only(input_root_dir):
-    filename = input_root_dir.split("\\")[-1]
+def find_screenlog_root(input_root_dir):
+    # Directory written by the filter mode, i.e. <work dir>/<video name>
+    if Path(input_root_dir).joinpath(regions[0].name, "SceneChanges.csv").is_file():
+        return Path(input_root_dir)
+    filename = str(input_root_dir).split("\\")[-1]
     log.debug(f" + filename: {filename}")
     
-    input_root_dir = input_root_dir.replace(filename, "")
-    screenlog_path = Path(input_root_dir).joinpath("output", filename, "default", "SceneChanges.csv")    # TODO: Fix this path error
+    input_root_dir = str(input_root_dir).replace(filename, "")
+    return Path(input_root_dir).joinpath("output", filename)    # TODO: Fix this path error
+
+
+def ocr_regions():
+    # Without a regions file, the alt screenlog is OCRed whenever it exists, even when -cropalty is not given
+    return regions if args.regions else Regions.default_regions(args.width or 0, args.height or 0, 0, 0)
+
+
+def new_ocr_only(input_root_dir):
+    screenlog_root = find_screenlog_root(input_root_dir)
+    first_region, *other_regions = ocr_regions()
+    screenlog_path = screenlog_root.joinpath(first_region.name, "SceneChanges.csv")
     
     if not os.path.isfile(screenlog_path):
         log.error(f" - No screenlog found in dir \"{screenlog_path}\", aborting.")
-        return (None,)
-    
-    alt_exists = Path(Path(input_root_dir).joinpath("alt", "SceneChanges.csv")).is_file()
-    log.debug(" + Alternative Screenlog found." if alt_exists else "No alternative Screenlog found.")
-    
-    default_path = Path(input_root_dir).joinpath("output", filename, "default")
-    one_screenlog = ocr_one_screenlog(default_path)
-    if alt_exists:
-        alt_path = Path(input_root_dir).joinpath("alt")
-        alts_screenlog = [(
-            "<font color=\"#ffff00\">" + text + "</font>", time
-        ) for (text, time) in ocr_one_screenlog(alt_path)]
-        
-        return one_screenlog, alts_screenlog
-    else:
-        return one_screenlog,
+        return (None,), None
+    
+    found_regions = [first_region] + [
+        region for region in other_regions
+        if screenlog_root.joinpath(region.name, "SceneChanges.csv").is_file()
+    ]
+    log.debug(f" + Screenlogs found: {', '.join(region.name for region in found_regions)}")
+    
+    # The scenes of every region are OCRed together so they can share mosaics and batches
+    region_scenes = []
+    fps = None
+    for region in found_regions:
+        scenes, region_fps = read_screenlog(screenlog_root.joinpath(region.name))
+        region_scenes.append(scenes)
+        fps = fps or region_fps
+    results = ocr_unique_scenes([scene for scenes in region_scenes for scene in scenes])
+    screenlogs = []
+    for region, scenes in zip(found_regions, region_scenes):
+        screenlogs.append([(region.wrap(text), time) for (text, time) in results[:len(scenes)] if text is not None])
+        results = results[len(scenes):]
+    return tuple(screenlogs), fps
 
 
-def post_process_subs(subsdata, outputdir, path):
+def post_process_subs(subsdata, fps, outputdir, path):
+    if subsdata[0] is None:
+        log.error(f" - No subtitles to convert for file {path}")
+        return
+    
+    global video_fps
+    video_fps = fps
+    
     # Merging everything and converting
     log.info(" + Correcting subtitles...") 
-    sub_data = check_sub_data(subsdata[0])
-    if len(subsdata) == 2:
-        sub_data += check_sub_data(subsdata[1])
+    sub_data = [data for region_data in subsdata for data in check_sub_data(region_data)]
     log.info(" + Converting to subtitle file...") 
     sub_data = sorted(sub_data, key=lambda file: int(file[1][0]))
     {
@@ -589,6 +1132,18 @@ def type_regex_replace(string):
         raise configargparse.ArgumentTypeError(f"- File \"{string}\" not found")
 
 
+def type_omp_threads(string):
+    if string.lower() == "auto":
+        return None
+    try:
+        omp_threads = int(string)
+    except ValueError:
+        raise configargparse.ArgumentTypeError(f"- \"{string}\" is neither a number nor \"auto\"")
+    if omp_threads < 1:
+        raise configargparse.ArgumentTypeError("- The number of threads must be at least 1")
+    return omp_threads
+
+
 def type_heurist_char_replace(string):
     try:
         with open(string, "r", encoding="utf8") as inputfile:
@@ -600,13 +1155,97 @@ def type_heurist_char_replace(string):
 
 
 def new_do_full(path):
+    if args.stream:
+        return new_do_full_streaming(path)
     new_filter_only(path, args.workdir)
+    return new_ocr_stage(path)
+
+
+def new_filter_stage(path):
+    new_filter_only(path, args.workdir)
+    return path
+
+
+def new_ocr_stage(path):
     path_ = Path(args.workdir).joinpath(PurePath(path).name)
     subsdata = new_ocr_only(path_)
     shutil.rmtree(path_, ignore_errors=True)
     return subsdata
 
 
+def new_do_full_streaming(path):
+    log.info(f" + Starting mode filter for file {path}, OCR will follow the filtering")
+    path_ = Path(args.workdir).joinpath(PurePath(path).name)
+    tracks = [region.name for region in ocr_regions()]
+    followers = {track: SceneStream.SceneLogFollower(path_.joinpath(track, "SceneChanges.jsonl")) for track in tracks}
+    builders = {
+        track: SceneStream.SceneBuilder(path_.joinpath(track), STREAM_REORDER_WINDOW) for track in tracks
+    }
+    results = {track: [] for track in tracks}
+    
+    # Scenes are OCRed by batches in a separate thread while the filter runs
+    ocr_queue = queue.Queue()
+
+    errors = []
+
+    def ocr_batches():
+        while True:
+            batch = ocr_queue.get()
+            if batch is None:
+                break
+            if errors:
+                continue
+            try:
+                for (track, _), result in zip(batch, ocr_unique_scenes([scene for _, scene in batch])):
+                    if result[0] is not None:
+                        results[track].append(result)
+            except Exception as e:
+                # Raised again in the filtering thread once the filter is done
+                errors.append(e)
+
+    ocr_thread = threading.Thread(target=ocr_batches)
+    ocr_thread.start()
+    index_path = begin_filter(path)
+    process = start_filter(path, args.workdir, index_path)
+    pending = []
+    while True:
+        finished = process.poll() is not None
+        for track in tracks:
+            for row in followers[track].poll():
+                builders[track].feed(*row)
+            pending += [(track, scene) for scene in builders[track].ready()]
+        if finished:
+            break
+        if len(pending) >= STREAM_BATCH_SIZE:
+            ocr_queue.put(pending)
+            pending = []
+        time.sleep(STREAM_POLL_INTERVAL)
+    try:
+        process.wait()
+    finally:
+        end_filter(path, index_path)
+    
+    if followers[tracks[0]].frame_count is None:
+        log.error(f" - No screenlog found in dir \"{path_.joinpath(tracks[0])}\", aborting.")
+        ocr_queue.put(None)
+        ocr_thread.join()
+        return (None,), None
+    last_frame = followers[tracks[0]].frame_count - 1
+    for track in tracks:
+        pending += [(track, scene) for scene in builders[track].finish(last_frame)]
+    ocr_queue.put(pending)
+    ocr_queue.put(None)
+    ocr_thread.join()
+    if errors:
+        raise errors[0]
+    shutil.rmtree(path_, ignore_errors=True)
+    
+    return tuple(
+        [(region.wrap(text), bounds) for (text, bounds) in results[region.name]]
+        for region in ocr_regions() if followers[region.name].frame_count is not None
+    ), followers[tracks[0]].fps
+
+
 if __name__ == "__main__":
     
     default_ass_style = "Style: Default,Verdana,55.5,&H00FFFFFF,&H000000FF,&H00282828,&H00000000,-1,0,0,0,100.2,100,0,0,1,3.75,0,2,0,0,79,1"
@@ -668,9 +1307,140 @@ if __name__ == "__main__":
                             "\n(It will ask for user input when some corrections are not automatically approved)")
     args_.add_argument("-d", "--delay", dest="delay", action="store_true",
                        help="Delay correction after every video is processed")
+    args_.add_argument("-fj", "--filter-jobs", dest="filter_jobs", metavar="number", type=int, default=1,
+                       help="Number of videos filtered at once (default: 1)")
+    args_.add_argument("-fc", "--filter-chunks", dest="filter_chunks", metavar="number", type=int, default=1,
+                       help="Number of frame ranges of a video filtered at once, their screenlogs are merged"
+                            "\n(default: 1, not used with --stream)")
+    args_.add_argument("-fp", "--filter-presence", dest="filter_presence", action="store_true",
+                       help="Find the frames that may hold text with a fast pass at a lower resolution, and only"
+                            "\nfilter them and a few frames around. Needs the VapourSynth python module"
+                            "\nor the numpy filter engine (not used with --stream)")
+    args_.add_argument("-fpv", "--filter-presence-verify", dest="filter_presence_verify", action="store_true",
+                       help="Also filter the whole videos after --filter-presence, log the frames where"
+                            "\nthe screenlogs differ and the time of both runs")
+    args_.add_argument("-fsd", "--filter-sample-duration", dest="filter_sample_duration", metavar="milliseconds",
+                       type=int, default=0,
+                       help="Compare frames sampled every given duration, and only search the exact scene"
+                            "\nchanges between the samples that differ. Keep it under the shortest subtitle"
+                            "\nduration. Needs the VapourSynth python module (default: 0, every frame)")
+    args_.add_argument("-oj", "--ocr-jobs", dest="ocr_jobs", metavar="number", type=int, default=1,
+                       help="Number of videos OCRed at once, they share the OCR threads (default: 1)")
+    args_.add_argument("-st", "--stream", dest="stream", action="store_true",
+                       help="In full mode, OCR the scenes while the video is still being filtered")
     args_.add_argument("-tss", "--tesseract-path", dest="tesseract_path", metavar="path to tesseract binary",
                        type=str, default="tesseract",
                        help="The path to call tesseract (default: tesseract)")
+    args_.add_argument("-oe", "--ocr-engine", dest="ocr_engine", metavar="engine",
+                       choices=OCREngine.ENGINES, default="auto", type=str.lower,
+                       help="OCR engine to use."
+                            "\n\"tesserocr\" keeps Tesseract loaded in worker processes between images"
+                            "\n\"cli\" calls the tesseract binary once per image"
+                            "\n\"fake\" needs no tesseract, returns replayed or synthetic results"
+                            "\n\"auto\" for tesserocr if installed, else cli (default: auto)")
+    args_.add_argument("-ofl", "--ocr-fake-latency", dest="ocr_fake_latency", metavar="seconds",
+                       type=float, default=0.,
+                       help="Time every recognition of the fake engine takes (default: 0)")
+    args_.add_argument("-orp", "--ocr-replay", dest="ocr_replay", metavar="path to recording",
+                       type=str, default=None,
+                       help="Recording of OCR results the fake engine replays, made with --ocr-record")
+    args_.add_argument("-orc", "--ocr-record", dest="ocr_record", metavar="path to recording",
+                       type=str, default=None,
+                       help="Append the result of every OCR call to this recording file")
+    args_.add_argument("-otr", "--ocr-transport", dest="ocr_transport", metavar="transport",
+                       choices=OCREngine.TRANSPORTS, default="file", type=str.lower,
+                       help="How the cli engine gives images held in memory to tesseract."
+                            "\n\"file\" writes a temporary PNG file for every image (default)"
+                            "\n\"stdin\" pipes them uncompressed (PGM) through the standard input")
+    args_.add_argument("-obs", "--ocr-batch-size", dest="ocr_batch_size", metavar="number",
+                       type=int, default=1,
+                       help="Number of images given to each tesseract call as a list file"
+                            "\n1 to OCR images one by one (default)")
+    args_.add_argument("-omo", "--ocr-mosaic", dest="ocr_mosaic", metavar="number",
+                       type=int, default=1,
+                       help="Number of images stacked into one tall image for each OCR call"
+                            "\n1 to OCR images one by one (default)")
+    args_.add_argument("-oln", "--ocr-lines", dest="ocr_lines", action="store_true",
+                       help="Split the images into text lines and OCR every line on its own"
+                            "\nin single line mode, identical lines are OCRed once")
+    args_.add_argument("-ocd", "--ocr-cache-dir", dest="ocr_cache_dir", metavar="folder", type=str, default=None,
+                       help="Directory of the OCR results cache (default: the work directory)")
+    args_.add_argument("-ocs", "--ocr-cache-size", dest="ocr_cache_size", metavar="number",
+                       type=float, default=0.,
+                       help="Maximum size of the OCR results cache in MB, e.g. 256, 0 to disable the cache"
+                            "\n(default: 0)")
+    args_.add_argument("-icd", "--index-cache-dir", dest="index_cache_dir", metavar="folder", type=str, default=None,
+                       help="Directory of the ffms2 index cache (default: ffindex in the work directory)")
+    args_.add_argument("-ics", "--index-cache-size", dest="index_cache_size", metavar="number",
+                       type=float, default=4096.,
+                       help="Maximum size of the ffms2 index cache in MB, 0 to disable the cache and delete"
+                            "\nthe index written next to the video after filtering it (default: 4096)")
+    args_.add_argument("-ocm", "--ocr-crop-margin", dest="ocr_crop_margin", metavar="number",
+                       type=int, default=-1,
+                       help="Crop the scene images to their text plus this margin in pixels before the OCR,"
+                            "\nblank images are skipped. -1 to disable (default)")
+    args_.add_argument("-ddt", "--dedupe-threshold", dest="dedupe_threshold", metavar="number",
+                       type=int, default=-1,
+                       help="Number of differing bits of the perceptual hash under which scene images"
+                            "\nare OCRed only once, -1 to disable (default). The hash is taken on the image"
+                            "\ndownscaled 4 times, so near-identical images share one OCR result even at 0")
+    args_.add_argument("-omp", "--ocr-omp-threads", dest="ocr_omp_threads", metavar="number",
+                       type=type_omp_threads, default=1,
+                       help="Number of threads each tesseract call may use (OMP_THREAD_LIMIT),"
+                            "\nthe OCR runs threads / this number tesseract calls at once."
+                            "\n\"auto\" to measure the fastest split on the first images (default: 1)")
+    args_.add_argument("-roc", "--reocr-confidence", dest="reocr_confidence", metavar="number",
+                       type=float, default=-1,
+                       help="Mean word confidence (0-100) under which an image is OCRed a second time"
+                            "\nwith the costlier re-OCR settings, -1 to disable (default)")
+    args_.add_argument("-row", "--reocr-word-ratio", dest="reocr_word_ratio", metavar="number",
+                       type=float, default=-1,
+                       help="Ratio of dictionary words (0-1) under which an image is OCRed a second time"
+                            "\nwith the costlier re-OCR settings, -1 to disable (default)")
+    args_.add_argument("-rou", "--reocr-upscale", dest="reocr_upscale", metavar="number",
+                       type=float, default=2.,
+                       help="Upscaling factor of the images for the re-OCR pass (default: 2)")
+    args_.add_argument("-rop", "--reocr-psm", dest="reocr_psm", metavar="number",
+                       type=int, default=None,
+                       help="Tesseract page segmentation mode of the re-OCR pass (default: same as the first pass)")
+    args_.add_argument("-oto", "--ocr-timeout", dest="ocr_timeout", metavar="seconds",
+                       type=float, default=0,
+                       help="Time the OCR of an image may take before it is abandoned, 0 for no limit (default)")
+    args_.add_argument("-ort", "--ocr-retries", dest="ocr_retries", metavar="number",
+                       type=int, default=1,
+                       help="Number of times a failed image is OCRed again (default: 1)"
+                            "\nA failed batch or mosaic is OCRed again image by image")
+    args_.add_argument("-ofp", "--ocr-fallback-psm", dest="ocr_fallback_psm", metavar="number",
+                       type=int, default=None,
+                       help="Tesseract page segmentation mode of the retries (default: same as the first try)")
+    args_.add_argument("-ofa", "--ocr-failure", dest="ocr_failure", metavar="policy",
+                       choices=["skip", "empty", "abort"], default="abort", type=str.lower,
+                       help="What to do with an image still failing after the retries."
+                            "\n\"skip\" leaves its scene out of the subtitles"
+                            "\n\"empty\" keeps its scene with an empty text"
+                            "\n\"abort\" stops the processing (default)"
+                            "\nFailed images are listed once every video is processed")
+    args_.add_argument("-fe", "--filter-engine", dest="filter_engine", metavar="engine",
+                       choices=["vspipe", "vapoursynth", "numpy"], default="vspipe", type=str.lower,
+                       help="How videos are filtered."
+                            "\n\"vspipe\" runs the vpy file with vspipe for every video (default)"
+                            "\n\"vapoursynth\" builds the filter graph in this process, without y4m output"
+                            "\n\"numpy\" cleans the decoded frames with NumPy and OpenCV, without VapourSynth"
+                            "\n(the vpy file is not used by the last two)")
+    args_.add_argument("-ffo", "--filter-full-output", dest="filter_full_output", action="store_true",
+                       help="Output every cleaned frame from the filter graph, instead of a 1 pixel summary"
+                            "\nof the scene detection where only the scene starts are rendered (slower)")
+    args_.add_argument("-fnd", "--filter-native-detection", dest="filter_native_detection", action="store_true",
+                       help="Detect the scene changes at the video resolution, only the frames starting a scene"
+                            "\nare supersampled and cleaned for OCR (faster, no effect with --filter-full-output)")
+    args_.add_argument("-fdc", "--filter-decoder", dest="filter_decoder", metavar="decoder",
+                       choices=NumpyFilter.DECODERS, default="ffmpeg", type=str.lower,
+                       help="Decoder of the numpy filter engine."
+                            "\n\"ffmpeg\" pipes the exact luma plane from ffmpeg, needs ffprobe too (default)"
+                            "\n\"opencv\" decodes to RGB with OpenCV, the luma is converted back")
+    args_.add_argument("-ffm", "--ffmpeg-path", dest="ffmpeg_path", metavar="path to ffmpeg binary",
+                       type=str, default="ffmpeg",
+                       help="The path to call ffmpeg, ffprobe is expected next to it (default: ffmpeg)")
     args_.add_argument("-vps", "--vapoursynth-path", dest="vapoursynth_path", metavar="path to vspipe binary",
                        type=str, default="vspipe",
                        help="The path to call vapoursynth (default: vspipe)")
@@ -698,6 +1468,11 @@ if __name__ == "__main__":
                        help="General detection threshold"
                        "\nLower values lead to more detected subs, more positive false"
                        "\nHigher values lead to subs difficult to detect")
+    args_.add_argument("-rg", "--regions", dest="regions", metavar="path to regions json", default=None,
+                       help="JSON list of the boxes to filter and OCR, replacing the default and alternative ones."
+                            "\nFields: name, width, height, y, x (-1 to center), white_thresh, black_thresh,"
+                            "\ndetection_top and style (default, alt, italic or a text holding {text})."
+                            "\nMissing fields take the values of the default box")
     
     args = args_.parse_args()
     
@@ -757,7 +1532,7 @@ if __name__ == "__main__":
     # colorama
     init()
     
-    if (args.mode == "full" or "filter-only") and args.vpy is None:
+    if args.mode in ("full", "filter") and args.vpy is None:
         log.exit(" - Please provide a vpy file for filter mode to work.")
     
     log.debug(f" + Creating directory at path {args.workdir}")
@@ -769,41 +1544,115 @@ if __name__ == "__main__":
     media_ext = {".avi", ".mp4", ".mkv", ".ts"}
     for path in args.path:
         if Path(path).is_file():
-            if PurePath(path).suffix[1] in media_ext:
+            if PurePath(path).suffix in media_ext:
                 files_to_process.append(path)
             else:
                 log.exit(f" - {path} is not a video file!")
         elif Path(path).is_dir() and args.mode != "ocr":
             for file in Path(path).iterdir():
-                if PurePath(file).suffix[1] in media_ext:
+                if PurePath(file).suffix in media_ext:
                     files_to_process.append(PurePath(path).joinpath(file))
         elif Path(path).is_dir() and args.mode == "ocr":        # TODO: STILL ERROR
             if ("." + path.split(".")[-1]) in media_ext:
                 files_to_process.append(path)
     
+    if args.regions:
+        try:
+            regions = Regions.load_regions(args.regions, Regions.Region(
+                "default", int(args.width or 0), int(args.height or 0), int(args.CropBox_y), -1,
+                int(args.WhiteThresh), int(args.BlackThresh)
+            ))
+        except (OSError, ValueError, TypeError) as e:
+            log.exit(f" - Cannot read the regions of {args.regions}: {e}")
+    else:
+        # The box size is not needed to OCR screenlogs
+        regions = Regions.default_regions(
+            args.width or 0, args.height or 0, args.CropBox_y, args.CropBoxAlt_y,
+            int(args.WhiteThresh), int(args.BlackThresh)
+        )
+    
+    if args.filter_engine == "numpy" and args.filter_sample_duration > 0:
+        log.exit(" - Sampled detection needs the VapourSynth filter graph, not the numpy filter engine")
+    if ((args.filter_engine != "vspipe" or args.filter_presence or args.filter_sample_duration > 0)
+            and args.mode != "ocr"):
+        try:
+            get_subs_filter()
+        except ImportError as e:
+            log.exit(f" - The vapoursynth filter engine, the presence pre-pass and sampled detection"
+                     f" need VapourSynth and its python plugins: {e}")
+    
+    # In-process engines read the OpenMP thread limit once, when they are loaded
+    os.environ["OMP_THREAD_LIMIT"] = str(args.ocr_omp_threads or 1)
+    ocr_engine = OCREngine.get_engine(
+        args.ocr_engine, args.tesseract_path, args.ocr_transport, args.ocr_fake_latency, args.ocr_replay
+    )
+    ocr_engine.timeout = args.ocr_timeout or None
+    if args.ocr_record:
+        ocr_engine = OCREngine.RecordingEngine(ocr_engine, args.ocr_record)
+    log.debug(f" + OCR engine used: {ocr_engine.name}")
+    ocr_scheduler = OCRScheduler.OCRScheduler(
+        args.threads, args.ocr_omp_threads, ocr_engine.set_omp_threads, ocr_engine.omp_configurable, log
+    )
+    ocr_cache = None
+    if args.ocr_cache_size > 0:
+        ocr_cache = OCRCache.OCRCache(
+            Path(args.ocr_cache_dir or args.workdir).joinpath("ocr_cache.sqlite"),
+            int(args.ocr_cache_size * 1024 * 1024)
+        )
+        log.debug(f" + OCR cache used: {ocr_cache.path}")
+    index_cache = None
+    if args.index_cache_size > 0 and args.mode != "ocr" and args.filter_engine != "numpy":
+        index_cache = IndexCache.IndexCache(
+            args.index_cache_dir or Path(args.workdir).joinpath("ffindex"),
+            int(args.index_cache_size * 1024 * 1024)
+        )
+        log.debug(f" + ffms2 index cache used: {index_cache.dir_}")
+
     log.debug(f" + Files to process:\n{files_to_process}")
     log.info(f" + Mode used: {args.mode}")
     
-    job = {
-        "full": new_do_full,
-        "ocr": new_ocr_only,
-        "filter": new_filter_only
-        }[args.mode]
-                    
+    # Filtering and OCR run in separate pools, so a video is filtered while the previous one is OCRed
+    if args.mode == "filter":
+        stages = [(functools.partial(new_filter_only, outputdir=args.outputdir), args.filter_jobs)]
+    elif args.mode == "ocr":
+        stages = [(new_ocr_only, args.ocr_jobs)]
+    elif args.stream:
+        stages = [(new_do_full_streaming, args.filter_jobs)]
+    else:
+        stages = [
+            (new_filter_stage, args.filter_jobs),
+            (new_ocr_stage, args.ocr_jobs)
+        ]
+    
     subsdatalist = []
-    for idx, file in enumerate(files_to_process):
-        log.info("Processing {}, file {} of {}".format(
-            PurePath(file).name,
-            idx + 1,
-            len(files_to_process)
-        ))
-        subsdata = job(file, args.outputdir) if args.mode == "filter" else job(file)
-        if not args.mode == "filter" and not args.delay:
-            post_process_subs(subsdata, args.outputdir, file)
-        else:
-            subsdatalist.append((subsdata, file))
+    pipeline = JobPipeline.JobPipeline(stages)
+    aborted = None
+    try:
+        for idx, (file, result) in enumerate(pipeline.run(files_to_process)):
+            log.info("Processed {}, file {} of {}".format(
+                PurePath(file).name,
+                idx + 1,
+                len(files_to_process)
+            ))
+            if args.mode == "filter":
+                continue
+            subsdata, fps = result
+            if not args.delay:
+                post_process_subs(subsdata, fps, args.outputdir, file)
+            else:
+                subsdatalist.append((subsdata, fps, file))
+    except OCRAborted as e:
+        aborted = e
+    finally:
+        if ocr_failures:
+            log.warning(" - OCR failed on these images:\n{}".format("\n".join(ocr_failures)))
+    if aborted is not None:
+        log.exit(f" - {aborted}, aborting (see --ocr-failure)")
              
-    if not args.mode == "filter":
-        for subsdata, path in subsdatalist:
-            post_process_subs(subsdata, args.outputdir, path)
-        
+    for subsdata, fps, path in subsdatalist:
+        post_process_subs(subsdata, fps, args.outputdir, path)
+
+    if ocr_cache is not None:
+        log.info(f" + OCR cache: {ocr_cache.hits} hits, {ocr_cache.misses} misses in total")
+        ocr_cache.close()
+    ocr_engine.close()
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import html
+from html.parser import HTMLParser
+from typing import NamedTuple, Optional
+
+LINE_CLASSES = {"ocr_line", "ocr_header", "ocr_caption", "ocr_textfloat"}
+ITALIC_TAGS = {"em", "i"}
+
+BBox = tuple[int, int, int, int]
+
+
+class HocrWord(NamedTuple):
+    text: str
+    bbox: BBox
+    confidence: float
+    italic: bool
+
+
+class HocrLine(NamedTuple):
+    bbox: BBox
+    words: tuple[HocrWord, ...]
+
+
+def _parse_title(title: str) -> tuple[Optional[BBox], float]:
+    bbox = None
+    confidence = -1.
+    for prop in title.split(";"):
+        values = prop.split()
+        if len(values) == 5 and values[0] == "bbox":
+            bbox = (int(values[1]), int(values[2]), int(values[3]), int(values[4]))
+        elif len(values) == 2 and values[0] == "x_wconf":
+            confidence = float(values[1])
+    return bbox, confidence
+
+
+class _HocrHandler(HTMLParser):
+    """Collect the lines and words of an hOCR document in a single pass."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines: list[HocrLine] = []
+        self._spans: list[Optional[str]] = []
+        self._italic = 0
+        self._line: Optional[tuple[BBox, list[HocrWord]]] = None
+        self._word: Optional[tuple[BBox, float, list[str], bool]] = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ITALIC_TAGS:
+            self._italic += 1
+            if self._word is not None:
+                self._word = self._word[:3] + (True,)
+            return
+        if tag != "span":
+            return
+        attrs = dict(attrs)
+        classes = set((attrs.get("class") or "").split())
+        bbox, confidence = _parse_title(attrs.get("title") or "")
+        if classes & LINE_CLASSES:
+            self._close_line()
+            self._line = (bbox or (0, 0, 0, 0), [])
+            self._spans.append("line")
+        elif "ocrx_word" in classes:
+            self._word = (bbox or (0, 0, 0, 0), confidence, [], self._italic > 0)
+            self._spans.append("word")
+        else:
+            self._spans.append(None)
+
+    def handle_endtag(self, tag):
+        if tag in ITALIC_TAGS:
+            self._italic = max(0, self._italic - 1)
+            return
+        if tag != "span" or not self._spans:
+            return
+        kind = self._spans.pop()
+        if kind == "word":
+            self._close_word()
+        elif kind == "line":
+            self._close_line()
+
+    def handle_data(self, data):
+        if self._word is not None:
+            self._word[2].append(data)
+
+    def _close_word(self):
+        if self._word is None:
+            return
+        bbox, confidence, text, italic = self._word
+        self._word = None
+        text = "".join(text).strip()
+        if text and self._line is not None:
+            self._line[1].append(HocrWord(text, bbox, confidence, italic))
+
+    def _close_line(self):
+        self._close_word()
+        if self._line is not None and self._line[1]:
+            self.lines.append(HocrLine(self._line[0], tuple(self._line[1])))
+        self._line = None
+
+    def close(self):
+        super().close()
+        self._close_line()
+
+
+def parse_hocr(html_content: str) -> list[HocrLine]:
+    """Parse an hOCR document or fragment into its lines of words."""
+    handler = _HocrHandler()
+    handler.feed(html_content)
+    handler.close()
+    return handler.lines
+
+
+def to_text(lines: list[HocrLine]) -> str:
+    """
+    Join the lines into subtitle text.
+
+    Runs of italic words are wrapped in <i></i>, a run continuing on the next
+    line is kept in the same <i></i>.
+    """
+    text_lines = []
+    for line in lines:
+        parts = []
+        italic = False
+        for word in line.words:
+            if word.italic and not italic:
+                parts.append("<i>" + word.text)
+            elif italic and not word.italic:
+                parts[-1] += "</i>"
+                parts.append(word.text)
+            else:
+                parts.append(word.text)
+            italic = word.italic
+        if italic:
+            parts[-1] += "</i>"
+        text_lines.append(" ".join(parts))
+    text = "\n".join(text_lines)
+    return text.replace("</i>\n<i>", "\n")
+
+
+def to_hocr(lines: list[HocrLine]) -> str:
+    """Serialize the lines back into a compact hOCR fragment."""
+    return "\n".join(
+        "<span class='ocr_line' title=\"bbox {} {} {} {}\">{}</span>".format(*line.bbox, " ".join(
+            "<span class='ocrx_word' title='bbox {} {} {} {}; x_wconf {:g}'>{}</span>".format(
+                *word.bbox, word.confidence,
+                "<em>" + html.escape(word.text) + "</em>" if word.italic else html.escape(word.text)
+            ) for word in line.words
+        )) for line in lines
+    )
+
+
+def shift(lines: list[HocrLine], dx: int, dy: int) -> list[HocrLine]:
+    """Move the boxes of the lines and of their words by (dx, dy)."""
+    def moved(bbox):
+        return (bbox[0] + dx, bbox[1] + dy, bbox[2] + dx, bbox[3] + dy)
+    return [
+        HocrLine(moved(line.bbox), tuple(word._replace(bbox=moved(word.bbox)) for word in line.words))
+        for line in lines
+    ]
+
+
+def scale(lines: list[HocrLine], factor: float) -> list[HocrLine]:
+    """Multiply the boxes of the lines and of their words by factor."""
+    def scaled(bbox):
+        return tuple(int(round(value * factor)) for value in bbox)
+    return [
+        HocrLine(scaled(line.bbox), tuple(word._replace(bbox=scaled(word.bbox)) for word in line.words))
+        for line in lines
+    ]
+
+
+def mean_confidence(lines: list[HocrLine]) -> float:
+    """Mean confidence of the words of the lines, -1 when no word has one."""
+    confidences = [word.confidence for line in lines for word in line.words if word.confidence >= 0]
+    if not confidences:
+        return -1.
+    return sum(confidences) / len(confidences)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from typing import Optional, Union
+
+import cv2 as cv
+import numpy as np
+
+
+def read_gray(img_path: Union[str, np.ndarray]) -> np.ndarray:
+    """Read a scene image as a single channel image, an image already in memory is returned as it is."""
+    if isinstance(img_path, np.ndarray):
+        return img_path
+    return cv.imread(str(img_path), cv.IMREAD_GRAYSCALE)
+
+
+def upscale(image: np.ndarray, factor: float) -> np.ndarray:
+    """Enlarge the image by factor, small glyphs are read better by tesseract once upscaled."""
+    return cv.resize(image, None, fx=factor, fy=factor, interpolation=cv.INTER_CUBIC)
+
+
+def write_image(img_path: str, image: np.ndarray) -> None:
+    cv.imwrite(str(img_path), image)
+
+
+def text_bbox(image: np.ndarray) -> Optional[tuple[int, int, int, int]]:
+    """Return the (left, top, right, bottom) box of the non-zero pixels, None for a blank image."""
+    rows = np.flatnonzero(image.any(axis=1))
+    if not rows.size:
+        return None
+    cols = np.flatnonzero(image.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def crop_to_text(image: np.ndarray, margin: int) -> tuple[Optional[np.ndarray], tuple[int, int]]:
+    """
+    Crop the image to its text box widened by margin pixels.
+
+    Returns the cropped image, None for a blank image, and the (left, top)
+    offset of the crop in the image, to move OCR boxes back.
+    """
+    bbox = text_bbox(image)
+    if bbox is None:
+        return None, (0, 0)
+    left, top = max(0, bbox[0] - margin), max(0, bbox[1] - margin)
+    right, bottom = min(image.shape[1], bbox[2] + margin), min(image.shape[0], bbox[3] + margin)
+    return image[top:bottom, left:right], (left, top)
+
+
+def split_lines(image: np.ndarray, margin: int = 4, min_height_ratio: float = 0.4) -> list[tuple[int, int]]:
+    """
+    Find the text lines of the image with its horizontal projection profile.
+
+    Returns the (top, bottom) rows of every line, widened by margin rows.
+    Runs of text rows shorter than min_height_ratio of the tallest one, as
+    diacritics or punctuation detached from their line, join the closest line.
+    """
+    filled = image.any(axis=1)
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], filled, [False])).astype(np.int8)))
+    runs = [[int(top), int(bottom)] for top, bottom in zip(edges[::2], edges[1::2])]
+    if not runs:
+        return []
+    min_height = max(bottom - top for top, bottom in runs) * min_height_ratio
+    lines = [run for run in runs if run[1] - run[0] >= min_height]
+    for top, bottom in runs:
+        if bottom - top < min_height:
+            closest = min(lines, key=lambda line: max(line[0] - bottom, top - line[1]))
+            closest[0], closest[1] = min(closest[0], top), max(closest[1], bottom)
+    return [(max(0, top - margin), min(image.shape[0], bottom + margin)) for top, bottom in lines]
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Union
+
+# Blocks hashed to fingerprint a video, spread evenly from its start to its end
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+
+def file_fingerprint(path: Union[Path, str]) -> str:
+    """
+    Fast fingerprint of a file content: its size, mtime and a hash of
+    evenly spaced blocks, so large videos are never read entirely.
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf8"))
+    with open(path, "rb") as ifile:
+        last_offset = max(0, stat.st_size - FINGERPRINT_SAMPLE_SIZE)
+        for sample_idx in range(FINGERPRINT_SAMPLES):
+            ifile.seek(last_offset * sample_idx // (FINGERPRINT_SAMPLES - 1))
+            digest.update(ifile.read(FINGERPRINT_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+class IndexCache:
+    """
+    Directory of ffms2 index files named after the fingerprint of their video.
+
+    The total size of the indexes is bounded, the least recently used ones
+    are deleted first. Indexes acquired by a running filter are never deleted.
+    """
+
+    def __init__(self, dir_: Union[Path, str], max_size: int):
+        self.dir_ = Path(dir_)
+        self.dir_.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._in_use: dict[Path, int] = {}
+
+    def acquire(self, video_path: Union[Path, str]) -> Path:
+        """
+        Return the index path of the video, which ffms2 creates when it does
+        not exist yet. It is kept until the matching release().
+        """
+        index_path = self.dir_.joinpath(file_fingerprint(video_path) + ".ffindex")
+        with self._lock:
+            self._in_use[index_path] = self._in_use.get(index_path, 0) + 1
+            if index_path.is_file():
+                # The modification time orders the indexes by last use
+                os.utime(index_path)
+        return index_path
+
+    def release(self, index_path: Path) -> None:
+        with self._lock:
+            self._in_use[index_path] -= 1
+            if not self._in_use[index_path]:
+                del self._in_use[index_path]
+            self._evict()
+
+    def _evict(self) -> None:
+        indexes = []
+        for index_path in self.dir_.glob("*.ffindex"):
+            try:
+                stat = index_path.stat()
+            except FileNotFoundError:
+                continue
+            indexes.append((stat.st_mtime, stat.st_size, index_path))
+        size = sum(index_size for _, index_size, _ in indexes)
+        for _, index_size, index_path in sorted(indexes):
+            if size <= self.max_size:
+                break
+            if index_path in self._in_use:
+                continue
+            index_path.unlink(missing_ok=True)
+            size -= index_size
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+# Marks the end of the items in a stage queue
+_DONE = object()
+
+
+class JobPipeline:
+    """
+    Run items through successive stages, each stage with its own pool of
+    worker threads.
+
+    Stages are linked by bounded queues, so an item can be in the second
+    stage while the next one is still in the first. Results are yielded in
+    the order of the items.
+    """
+
+    def __init__(self, stages: list[tuple[Callable[[Any], Any], int]], queue_size: int = 1):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def _stage_worker(self, func: Callable[[Any], Any], inbox: queue.Queue, outbox: queue.Queue) -> None:
+        while True:
+            job = inbox.get()
+            if job is _DONE:
+                inbox.put(_DONE)
+                return
+            idx, value, error = job
+            if error is None:
+                try:
+                    value = func(value)
+                except Exception as e:
+                    error = e
+            outbox.put((idx, value, error))
+
+    def _close_stage(self, workers: list[threading.Thread], outbox: queue.Queue) -> None:
+        for worker in workers:
+            worker.join()
+        outbox.put(_DONE)
+
+    def run(self, items: Iterable[Any]) -> Iterator[tuple[Any, Any]]:
+        """
+        Yield (item, result) in the items order.
+
+        An exception raised by a stage is raised again when its item is reached.
+        """
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages] + [queue.Queue()]
+        threads = []
+        for stage_idx, (func, worker_count) in enumerate(self.stages):
+            workers = [
+                threading.Thread(
+                    target=self._stage_worker, args=(func, queues[stage_idx], queues[stage_idx + 1]), daemon=True
+                ) for _ in range(max(1, worker_count))
+            ]
+            threads += workers
+            threads.append(threading.Thread(
+                target=self._close_stage, args=(workers, queues[stage_idx + 1]), daemon=True
+            ))
+
+        def feed():
+            for idx, item in enumerate(items):
+                queues[0].put((idx, item, None))
+            queues[0].put(_DONE)
+
+        threads.append(threading.Thread(target=feed, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        done: dict[int, tuple[Any, Any]] = {}
+        for idx, item in enumerate(items):
+            while idx not in done:
+                job = queues[-1].get()
+                if job is _DONE:
+                    continue
+                done[job[0]] = (job[1], job[2])
+            value, error = done.pop(idx)
+            if error is not None:
+                raise error
+            yield item, value
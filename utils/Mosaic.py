@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from typing import Optional, Union
+
+import numpy as np
+
+from utils import HocrParser, ImagePrep
+from utils.HocrParser import HocrLine
+from utils.OCREngine import OCREngine
+
+# Blank rows between two stacked images, keeps tesseract from merging their lines
+DEFAULT_GAP = 48
+
+
+def build_mosaic(img_paths: list[Union[str, np.ndarray]],
+                 gap: int = DEFAULT_GAP) -> tuple[np.ndarray, list[tuple[int, int]]]:
+    """
+    Stack the images vertically, separated by gap blank rows.
+
+    Returns the composite image and the (top, bottom) rows of every image in it.
+    """
+    images = [ImagePrep.read_gray(img_path) for img_path in img_paths]
+    width = max(image.shape[1] for image in images)
+    height = sum(image.shape[0] for image in images) + gap * (len(images) + 1)
+    mosaic = np.zeros((height, width), dtype=np.uint8)
+    ranges = []
+    top = gap
+    for image in images:
+        mosaic[top:top + image.shape[0], :image.shape[1]] = image
+        ranges.append((top, top + image.shape[0]))
+        top += image.shape[0] + gap
+    return mosaic, ranges
+
+
+def split_mosaic_lines(lines: list[HocrLine], ranges: list[tuple[int, int]],
+                       gap: int = DEFAULT_GAP) -> list[list[HocrLine]]:
+    """
+    Assign the hOCR lines of a mosaic back to the stacked images.
+
+    A line belongs to the image whose rows, widened by half a gap, contain
+    its vertical center. Its boxes are moved into the coordinates of that image.
+    """
+    image_lines: list[list[HocrLine]] = [[] for _ in ranges]
+    for line in lines:
+        center = (line.bbox[1] + line.bbox[3]) / 2
+        for img_idx, (top, bottom) in enumerate(ranges):
+            if top - gap / 2 <= center < bottom + gap / 2:
+                image_lines[img_idx] += HocrParser.shift([line], 0, -top)
+                break
+    return image_lines
+
+
+def recognize_mosaic(engine: OCREngine, img_paths: list[Union[str, np.ndarray]], language: str,
+                     gap: int = DEFAULT_GAP, tmp_dir: Optional[str] = None) -> list[list[HocrLine]]:
+    """OCR the images with a single engine call on their mosaic, returns the lines of every image."""
+    mosaic, ranges = build_mosaic(img_paths, gap)
+    html_content = engine.recognize_array(mosaic, language, tmp_dir=tmp_dir)
+    return split_mosaic_lines(HocrParser.parse_hocr(html_content), ranges, gap)
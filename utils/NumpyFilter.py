@@ -0,0 +1,448 @@
+from __future__ import annotations
+
+import json
+import subprocess
+from fractions import Fraction
+from pathlib import Path, PurePath
+from typing import Iterator, Optional, Union
+
+import cv2 as cv
+import numpy as np
+
+from utils.Regions import Region, check_regions, default_regions
+from utils.SubsFilter import (Chunk, SceneLogWriter, boxes_have_text, chunk_span, luma_only, presence_size,
+                              track_dirs, upscale_factors)
+
+DECODERS = ["ffmpeg", "opencv"]
+
+# Frames decoded and cleaned at once
+BLOCK_SIZE = 32
+
+# Frames between two spans under which decoding through them is cheaper than seeking again
+SEEK_GAP = 250
+
+# Width of the border a bright shape must touch to be removed, as the Rect clip of the vpy
+BORDER = 10
+
+# Neighbourhoods of the 3x3 minimums and maximums iterated by havsfunc, which approximate an ellipse
+SQUARE = np.ones((3, 3), np.uint8)
+CROSS = cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))
+
+
+def binarize(planes: np.ndarray, threshold: int) -> np.ndarray:
+    """255 where planes reach threshold, 0 elsewhere, as std.Binarize."""
+    return (planes >= threshold).astype(np.uint8) * 255
+
+
+def rgb_binarize(rgb: np.ndarray, threshold: list) -> np.ndarray:
+    """255 where a channel reaches its value in one of the (r, g, b) triples of threshold."""
+    mask = np.zeros(rgb.shape[:-1], dtype=bool)
+    for i in range(0, len(threshold) // 3 * 3, 3):
+        mask |= (rgb[..., 0] >= threshold[i]) | (rgb[..., 1] >= threshold[i + 1]) | (rgb[..., 2] >= threshold[i + 2])
+    return mask.astype(np.uint8) * 255
+
+
+def yuv_to_rgb(yuv: np.ndarray) -> np.ndarray:
+    """Limited range BT.709 YUV, channels last, to full range RGB as fmtc.matrix does."""
+    y = (yuv[..., 0].astype(np.float32) - 16) * (255 / 219)
+    u = (yuv[..., 1].astype(np.float32) - 128) * (255 / 224)
+    v = (yuv[..., 2].astype(np.float32) - 128) * (255 / 224)
+    rgb = np.stack([y + 1.5748 * v, y - 0.1873 * u - 0.4681 * v, y + 1.8556 * u], axis=-1)
+    return np.clip(rgb + 0.5, 0, 255).astype(np.uint8)
+
+
+def rgb_to_luma(rgb: np.ndarray) -> np.ndarray:
+    """Full range RGB back to the limited range BT.709 luma the thresholds are meant for."""
+    y = rgb.astype(np.float32) @ np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+    return (16 + y * (219 / 255) + 0.5).astype(np.uint8)
+
+
+def _stacked(planes: np.ndarray, func, pad_value: int) -> np.ndarray:
+    # Runs a 2D OpenCV function on every frame at once, a pad_value row keeps the frames apart
+    count, height, width = planes.shape
+    stack = np.full((count, height + 1, width), pad_value, dtype=np.uint8)
+    stack[:, :height] = planes
+    return func(stack.reshape(count * (height + 1), width)).reshape(count, height + 1, width)[:, :height]
+
+
+def inpand(planes: np.ndarray, size: int) -> np.ndarray:
+    """Elliptic erosion of size pixels, as havsfunc.mt_inpand_multi."""
+    for step in range(size, 0, -1):
+        kernel = CROSS if step % 3 != 1 else SQUARE
+        planes = _stacked(planes, lambda image: cv.erode(image, kernel), 255)
+    return planes
+
+
+def expand(planes: np.ndarray, size: int) -> np.ndarray:
+    """Elliptic dilation of size pixels, as havsfunc.mt_expand_multi."""
+    for step in range(size, 0, -1):
+        kernel = CROSS if step % 3 != 1 else SQUARE
+        planes = _stacked(planes, lambda image: cv.dilate(image, kernel), 0)
+    return planes
+
+
+def hysteresis(seed: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """The 8-connected shapes of mask holding a pixel of seed, as misc.Hysteresis."""
+    labels = _stacked(mask, lambda image: cv.connectedComponents(image, connectivity=8)[1].astype(np.int32), 0)
+    kept = np.zeros(int(labels.max()) + 1, dtype=bool)
+    kept[labels[(seed > 0) & (mask > 0)]] = True
+    kept[0] = False
+    return kept[labels].astype(np.uint8) * 255
+
+
+def scene_changes(planes: np.ndarray, previous: Optional[np.ndarray], threshold: float) -> np.ndarray:
+    """
+    Whether every plane starts a scene: its normalized mean absolute
+    difference with the one before, previous for the first, is above threshold.
+    """
+    planes = planes.astype(np.int16)
+    if previous is None:
+        previous = planes[0]
+    diffs = np.abs(planes - np.concatenate(([previous.astype(np.int16)], planes[:-1]))).mean(axis=(1, 2)) / 255
+    return diffs > threshold
+
+
+def _probe(source: str, ffprobe_path: str) -> tuple[int, int, float, int]:
+    output = subprocess.run([
+        ffprobe_path, "-v", "error", "-select_streams", "v:0", "-count_packets",
+        "-show_entries", "stream=width,height,r_frame_rate,nb_read_packets", "-of", "json", source
+    ], stdout=subprocess.PIPE, check=True).stdout
+    stream = json.loads(output)["streams"][0]
+    return (int(stream["width"]), int(stream["height"]), float(Fraction(stream["r_frame_rate"])),
+            int(stream["nb_read_packets"]))
+
+
+def decode_ranges(spans: Optional[list[Chunk]]) -> list[tuple[int, Optional[int]]]:
+    """
+    [start, end) frames to decode for spans, each one seeked to. Spans less
+    than SEEK_GAP frames apart are decoded at once. end is None for the end of the video.
+    """
+    if spans is None:
+        return [(0, None)]
+    ranges: list[tuple[int, Optional[int]]] = []
+    for span in sorted(spans):
+        if ranges and span.filter_start - ranges[-1][1] < SEEK_GAP:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], span.filter_end))
+        else:
+            ranges.append((span.filter_start, span.filter_end))
+    return ranges
+
+
+class FrameReader:
+    """
+    Decode the frames of a video, cropped to a band of rows, by blocks.
+
+    ffmpeg pipes the exact luma plane, and the chroma upsampled to 4:4:4
+    when RGB is needed. OpenCV decodes to RGB, the luma is converted back.
+    """
+
+    def __init__(self, source: str, decoder: str = "ffmpeg", ffmpeg_path: str = "ffmpeg"):
+        self.source = source
+        self.decoder = decoder
+        self.ffmpeg_path = ffmpeg_path
+        if decoder == "ffmpeg":
+            # ffprobe is installed next to ffmpeg
+            ffmpeg_name = PurePath(ffmpeg_path).name
+            ffprobe_path = str(PurePath(ffmpeg_path).with_name(ffmpeg_name.replace("ffmpeg", "ffprobe")))
+            self.width, self.height, self.fps, self.frame_count = _probe(source, ffprobe_path)
+        else:
+            capture = cv.VideoCapture(source)
+            if not capture.isOpened():
+                raise OSError(f"OpenCV cannot open {source}")
+            self.width = int(capture.get(cv.CAP_PROP_FRAME_WIDTH))
+            self.height = int(capture.get(cv.CAP_PROP_FRAME_HEIGHT))
+            self.fps = float(capture.get(cv.CAP_PROP_FPS))
+            self.frame_count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+            capture.release()
+
+    def blocks(self, left: int, top: int, width: int, height: int, rgb: bool = False,
+               block_size: int = BLOCK_SIZE, start: int = 0,
+               end: Optional[int] = None) -> Iterator[tuple[np.ndarray, Optional[np.ndarray]]]:
+        """
+        Yield the luma of [top, top + height) x [left, left + width) for
+        block_size frames at once, with its RGB when rgb is set.
+
+        Only the frames [start, end) are decoded, the video is seeked to start.
+        """
+        if self.decoder == "opencv":
+            yield from self._opencv_blocks(left, top, width, height, rgb, block_size, start, end)
+            return
+        crop = f"crop={width}:{height}:{left}:{top}:exact=1"
+        vf = f"format=yuv444p,{crop}" if rgb else f"{crop},extractplanes=y,format=gray"
+        frame_size = width * height * (3 if rgb else 1)
+        # An input seek decodes from the previous keyframe and drops the frames before the time given, half a
+        # frame before start so rounded timestamps keep it
+        seek = ["-ss", f"{(start - 0.5) / self.fps:.6f}"] if start > 0 else []
+        frame_limit = ["-frames:v", str(end - start)] if end is not None else []
+        process = subprocess.Popen([
+            self.ffmpeg_path, "-v", "error", *seek, "-i", self.source, "-map", "0:v:0", "-vf", vf,
+            "-vsync", "passthrough", *frame_limit, "-f", "rawvideo", "-"
+        ], stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = process.stdout.read(frame_size * block_size)
+                count = len(data) // frame_size
+                if not count:
+                    break
+                frames = np.frombuffer(data, dtype=np.uint8, count=count * frame_size)
+                if rgb:
+                    yuv = frames.reshape(count, 3, height, width).transpose(0, 2, 3, 1)
+                    yield np.ascontiguousarray(yuv[..., 0]), yuv_to_rgb(yuv)
+                else:
+                    yield frames.reshape(count, height, width), None
+        finally:
+            process.kill()
+            process.wait()
+
+    def _opencv_blocks(self, left, top, width, height, rgb, block_size, start, end):
+        capture = cv.VideoCapture(self.source)
+        if start > 0:
+            capture.set(cv.CAP_PROP_POS_FRAMES, start)
+        # The frame count of OpenCV may be an estimate, without end the frames are read until the last one
+        remaining = float("inf") if end is None else end - start
+        try:
+            while remaining > 0:
+                frames = []
+                while len(frames) < min(block_size, remaining):
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    frames.append(frame[top:top + height, left:left + width, ::-1])
+                if not frames:
+                    break
+                remaining -= len(frames)
+                block = np.stack(frames)
+                yield rgb_to_luma(block), (block if rgb else None)
+        finally:
+            capture.release()
+
+
+class _Track:
+    """A region at (left, top) of the decoded band and its scene detection state between two blocks."""
+
+    def __init__(self, region: Region, left: int, top: int, writer: SceneLogWriter):
+        self.region = region
+        self.left = left
+        self.top = top
+        self.writer = writer
+        self.previous: Optional[np.ndarray] = None
+        # Last frame of the previous block, (n, is_start, max), logged once the next frame is known
+        self.pending: Optional[tuple[int, bool, int]] = None
+
+    def log(self, n: int, is_start: bool, is_end: bool, maximum: int) -> None:
+        if (is_start or is_end) and maximum > 1:
+            self.writer.frame_done(n, int(is_start), int(is_end), self.writer.image_name(n) if is_start else "")
+        else:
+            self.writer.frame_done(n)
+
+
+class NumpyFilter:
+    """
+    The subtitle filter of SubsFilter on decoded frames with NumPy and OpenCV,
+    without VapourSynth or its plugins. Screenlogs and images are laid out the same.
+
+    Frames are cleaned by blocks of block_size, every region is cut from a
+    single decoded band. Supersampling always uses a Lanczos resize, and no
+    ffms2 index is used.
+    """
+
+    def __init__(self, width: int, height: int, cropbox_y: int = 0, cropbox_alt_y: int = -1,
+                 supersampling: int = -1, expand_ratio: int = 1, resampler: str = "sinc",
+                 white_thresh: Union[int, list] = 230, black_thresh: Union[int, list] = 80,
+                 detection_thresh: float = 0.03, native_detection: bool = False, decoder: str = "ffmpeg",
+                 ffmpeg_path: str = "ffmpeg", block_size: int = BLOCK_SIZE, regions: Optional[list[Region]] = None):
+        self.supersampling = int(supersampling)
+        self.expand_ratio = int(expand_ratio)
+        self.mode_u = resampler
+        self.threshold_i = white_thresh
+        self.threshold_o = black_thresh
+        self.threshold_scd = float(detection_thresh)
+        self.native_detection = native_detection
+        self.decoder = decoder
+        self.ffmpeg_path = ffmpeg_path
+        self.block_size = block_size
+        self.regions = regions or default_regions(
+            width, height, cropbox_y, cropbox_alt_y, white_thresh, black_thresh
+        )
+
+    def _band(self, reader: FrameReader) -> tuple[int, int, int, int, list[tuple[int, int]]]:
+        # Left, top, width and height of the band holding every region, and the (left, top) of each one in it
+        check_regions(self.regions, reader.width, reader.height)
+        boxes = [(region.left(reader.width), region.top(reader.height)) for region in self.regions]
+        left, top = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        right = max(box[0] + region.width for box, region in zip(boxes, self.regions))
+        bottom = max(box[1] + region.height for box, region in zip(boxes, self.regions))
+        return left, top, right - left, bottom - top, [(box[0] - left, box[1] - top) for box in boxes]
+
+    def cleaning(self, luma: np.ndarray, rgb: Optional[np.ndarray], e: float,
+                 threshold_i: Union[int, list, None] = None, threshold_o: Union[int, list, None] = None,
+                 native: bool = False) -> np.ndarray:
+        """Clean a block of boxes, as SubsFilter.cleaning, e is the expand ratio in pixels."""
+        threshold_i = self.threshold_i if threshold_i is None else threshold_i
+        threshold_o = self.threshold_o if threshold_o is None else threshold_o
+        white_raw = binarize(luma, threshold_i) if type(threshold_i) is int else rgb_binarize(rgb, threshold_i)
+        bright_raw = binarize(luma, threshold_o) if type(threshold_o) is int else rgb_binarize(rgb, threshold_o)
+
+        # Bright shapes touching the border of the box are not subtitles
+        rect = np.ones(luma.shape[1:], dtype=bool)
+        rect[BORDER:-BORDER, BORDER:-BORDER] = False
+        bright_out = np.where(rect, bright_raw, 0)
+        white_txt = np.where(hysteresis(bright_out, bright_raw) > 0, 0, white_raw)
+
+        lb_size = max(1, int(e)) if native else int(e)
+        white_lb = expand(inpand(white_txt, lb_size), lb_size)
+        white_ub = expand(inpand(white_txt, int(5 * e)), int(3 * e))
+        white = np.where(white_ub > 0, 0, white_lb)
+        white = hysteresis(white, white_txt)
+
+        clip_cleaning = np.where(white > 0, white_raw, 0).astype(np.uint8)
+        return np.stack([cv.medianBlur(plane, 3) for plane in clip_cleaning])
+
+    def _resized(self, planes: Optional[np.ndarray], scale: float) -> Optional[np.ndarray]:
+        if planes is None or scale == 1:
+            return planes
+        size = (int(round(planes.shape[2] * scale)), int(round(planes.shape[1] * scale)))
+        return np.stack([cv.resize(plane, size, interpolation=cv.INTER_LANCZOS4) for plane in planes])
+
+    def _sc_crop(self, planes: np.ndarray, sc_top: float) -> np.ndarray:
+        # Same part of the box as the CropAbs of SubsFilter.track_clips
+        height, width = planes.shape[1:]
+        left, top = int(width * (1 - 1 / 2.7) / 2), int(height * sc_top)
+        return planes[:, top:top + int(height / 2.7), left:left + int(width / 2.7)]
+
+    def _filter_block(self, track: _Track, ns: np.ndarray, luma: np.ndarray, rgb: Optional[np.ndarray],
+                      scale: float, native: bool) -> None:
+        region = track.region
+        thresholds = (region.white_thresh, region.black_thresh)
+        box = (slice(None), slice(track.top, track.top + region.height), slice(track.left, track.left + region.width))
+        luma = luma[box]
+        rgb = rgb[box] if rgb is not None else None
+        if native:
+            # Morphology sizes are in supersampled pixels
+            detected = self.cleaning(luma, rgb, self.expand_ratio / scale, *thresholds, native=True)
+            cleaned = None
+        else:
+            cleaned = self.cleaning(
+                self._resized(luma, scale), self._resized(rgb, scale), self.expand_ratio, *thresholds
+            )
+            detected = cleaned
+        sc_planes = self._sc_crop(detected, region.detection_top)
+        starts = scene_changes(sc_planes, track.previous, self.threshold_scd)
+        maxima = sc_planes.max(axis=(1, 2))
+        track.previous = sc_planes[-1].copy()
+
+        captured = np.flatnonzero(starts & (maxima > 1))
+        if captured.size:
+            if native:
+                images = self.cleaning(
+                    self._resized(luma[captured], scale),
+                    self._resized(rgb[captured], scale) if rgb is not None else None, self.expand_ratio,
+                    *thresholds
+                )
+            else:
+                images = cleaned[captured]
+            for idx, image in zip(captured, images):
+                cv.imwrite(str(track.writer.dir_.joinpath(track.writer.image_name(int(ns[idx])))), image)
+
+        if track.pending is not None:
+            track.log(*track.pending[:2], bool(starts[0]), track.pending[2])
+        for idx in range(len(ns) - 1):
+            track.log(int(ns[idx]), bool(starts[idx]), bool(starts[idx + 1]), int(maxima[idx]))
+        track.pending = (int(ns[-1]), bool(starts[-1]), int(maxima[-1]))
+
+    def presence_ranges(self, source: str,
+                        index_path: Optional[str] = None) -> tuple[list[tuple[int, int]], int, float]:
+        """Same as SubsFilter.presence_ranges, on the boxes decoded by this filter."""
+        reader = FrameReader(source, self.decoder, self.ffmpeg_path)
+        if not luma_only(self.regions):
+            return [(0, reader.frame_count)], reader.frame_count, reader.fps
+
+        *band, offsets = self._band(reader)
+        sizes = [presence_size(region) for region in self.regions]
+        stacked = np.zeros((sum(size[1] for size in sizes), max(size[0] for size in sizes)), dtype=np.uint8)
+        ranges: list[tuple[int, int]] = []
+        n = 0
+        for luma, _ in reader.blocks(*band, block_size=self.block_size):
+            for frame in luma:
+                top = 0
+                for region, (left, box_top), size in zip(self.regions, offsets, sizes):
+                    box = frame[box_top:box_top + region.height, left:left + region.width]
+                    stacked[top:top + size[1], :size[0]] = cv.resize(box, size, interpolation=cv.INTER_LINEAR)
+                    top += size[1]
+                if boxes_have_text(stacked, self.regions):
+                    if ranges and ranges[-1][1] == n:
+                        ranges[-1] = (ranges[-1][0], n + 1)
+                    else:
+                        ranges.append((n, n + 1))
+                n += 1
+        return ranges, n, reader.fps
+
+    def build(self, source: str, output_dir: Union[Path, str],
+              chunk_count: int = 1, chunk_id: int = 0, index_path: Optional[str] = None,
+              spans: Optional[list[Chunk]] = None) -> tuple[BlockRun, list[SceneLogWriter]]:
+        """
+        Same as SubsFilter.build, index_path is not used. Returns the run
+        filtering the video and the scene log writers.
+        """
+        reader = FrameReader(source, self.decoder, self.ffmpeg_path)
+        dirs = track_dirs(
+            source, output_dir, [region.name for region in self.regions],
+            f"chunk{chunk_id}" if chunk_count > 1 or spans is not None else None
+        )
+        ss, ssbis = upscale_factors(self.supersampling, self.mode_u, reader.width, reader.height)
+        frame_count = reader.frame_count
+        if spans is None and chunk_count > 1:
+            spans = [chunk_span(frame_count, chunk_count, chunk_id)]
+        writers = [
+            SceneLogWriter(dir_, reader.fps, frame_count, len(str(frame_count)), spans=spans) for dir_ in dirs
+        ]
+        return BlockRun(self, reader, writers, ss * ssbis, spans), writers
+
+
+class BlockRun:
+    """
+    Filtering of a video by NumpyFilter. Mimics the frames() of the clip
+    returned by SubsFilter.build, every item is a block of filtered frames.
+    """
+
+    def __init__(self, numpy_filter: NumpyFilter, reader: FrameReader, writers: list[SceneLogWriter],
+                 scale: float, spans: Optional[list[Chunk]] = None):
+        self.numpy_filter = numpy_filter
+        self.reader = reader
+        self.scale = scale
+        self.spans = spans
+        *self.band, offsets = numpy_filter._band(reader)
+        self.tracks = [
+            _Track(region, left, top, writer)
+            for region, (left, top), writer in zip(numpy_filter.regions, offsets, writers)
+        ]
+
+    def frames(self, close: bool = False) -> Iterator[int]:
+        """Filter the video, yields the number of frames of every block."""
+        numpy_filter, reader = self.numpy_filter, self.reader
+        native = numpy_filter.native_detection and self.scale != 1
+        # Position of every video frame in the filtered ones, -1 for the frames left out
+        local = None
+        if self.spans is not None:
+            local = np.full(reader.frame_count, -1, dtype=np.int64)
+            frame_map = np.array([n for span in self.spans for n in range(span.filter_start, span.filter_end)])
+            local[frame_map] = np.arange(len(frame_map))
+        rgb_needed = not luma_only(numpy_filter.regions)
+        for start, end in decode_ranges(self.spans):
+            first = start
+            for luma, rgb in reader.blocks(*self.band, rgb_needed, numpy_filter.block_size, start, end):
+                ns = np.arange(first, first + len(luma))
+                first += len(luma)
+                if local is not None:
+                    ns = local[ns[ns < len(local)]]
+                    selected = np.flatnonzero(ns >= 0)
+                    luma, rgb, ns = luma[selected], rgb[selected] if rgb is not None else None, ns[selected]
+                    if not len(ns):
+                        continue
+                for track in self.tracks:
+                    numpy_filter._filter_block(track, ns, luma, rgb, self.scale, native)
+                yield len(ns)
+        for track in self.tracks:
+            if track.pending is not None:
+                track.log(*track.pending[:2], False, track.pending[2])
+            track.writer.finish()
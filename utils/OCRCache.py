@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import cv2 as cv
+import numpy as np
+
+
+def image_key(pixels: np.ndarray, *settings: object) -> str:
+    """Hash decoded image pixels together with the OCR settings that produced the result."""
+    digest = hashlib.sha256()
+    digest.update(repr((pixels.shape, pixels.dtype.str) + settings).encode("utf8"))
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+def image_file_key(img_path: Union[Path, str], *settings: object) -> str:
+    """Hash the decoded pixels of the image at img_path, so re-encoding an image keeps its key."""
+    pixels = cv.imread(str(img_path), cv.IMREAD_UNCHANGED)
+    if pixels is None:
+        raise IOError(f"Can't read image {img_path}")
+    return image_key(pixels, *settings)
+
+
+class OCRCache:
+    """
+    Content-addressed on-disk cache of OCR results stored in a SQLite file.
+
+    Entries map an image key to its text and hOCR. The total size of the
+    entries is bounded, least recently used entries are evicted first.
+    """
+
+    def __init__(self, path: Union[Path, str], max_size: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_results ("
+            "key TEXT PRIMARY KEY, text TEXT, hocr TEXT, size INTEGER, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS ocr_results_lru ON ocr_results (last_used)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_results").fetchone()[0]
+
+    def get(self, key: str) -> Optional[tuple[str, str]]:
+        """Return the (text, hocr) stored for key, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT text, hocr FROM ocr_results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Committed at once, an open transaction would keep the database locked for the other processes
+            with self._db:
+                self._db.execute("UPDATE ocr_results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0], row[1]
+
+    def put(self, key: str, text: str, hocr: str) -> None:
+        size = len(key) + len(text.encode("utf8")) + len(hocr.encode("utf8"))
+        if size > self.max_size:
+            return
+        with self._lock, self._db:
+            old = self._db.execute("SELECT size FROM ocr_results WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO ocr_results (key, text, hocr, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, text, hocr, size, time.time())
+            )
+            self._size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_size:
+            rows = self._db.execute(
+                "SELECT key, size FROM ocr_results ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for key, size in rows:
+                if self._size <= self.max_size:
+                    break
+                self._db.execute("DELETE FROM ocr_results WHERE key = ?", (key,))
+                self._size -= size
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
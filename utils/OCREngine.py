@@ -0,0 +1,444 @@
+from __future__ import annotations
+
+import html
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import cv2 as cv
+import numpy as np
+
+from utils import ImagePrep, OCRCache
+
+# Page segmentation mode used for a whole subtitle block
+DEFAULT_PSM = 6
+# Page segmentation mode used for a single text line
+LINE_PSM = 7
+
+# How the tesseract binary receives the images
+TRANSPORTS = ("file", "stdin")
+
+HOCR_PAGE_RE = re.compile(r"<div class=['\"]ocr_page['\"][^>]*title=['\"]image \"([^\"]*)\"")
+
+
+class OCRError(Exception):
+    """Raised when the engine fails or times out on an image."""
+
+
+def _import_tesserocr() -> Optional[Any]:
+    """Import tesserocr lazily, it is an optional dependency."""
+    try:
+        import tesserocr
+    except ImportError:
+        return None
+    return tesserocr
+
+
+class OCREngine:
+    """Base class of the OCR backends, turns a scene image into hOCR."""
+
+    name = "base"
+    psm = DEFAULT_PSM
+    # Seconds an image may take before its recognition is abandoned, None for no limit
+    timeout: Optional[float] = None
+    # Whether set_omp_threads takes effect after the engine is loaded
+    omp_configurable = False
+
+    def version(self) -> str:
+        """Identify the engine and its version, results of different versions may differ."""
+        return self.name
+
+    def set_omp_threads(self, omp_threads: int) -> None:
+        """Limit the number of OpenMP threads used by each recognition."""
+
+    def recognize(self, img_path: str, language: str, psm: Optional[int] = None) -> str:
+        """Return the hOCR of the image at img_path, psm overrides the engine page segmentation mode."""
+        raise NotImplementedError
+
+    def recognize_array(self, image: np.ndarray, language: str, psm: Optional[int] = None,
+                        tmp_dir: Optional[str] = None) -> str:
+        """Return the hOCR of a grayscale image held in memory."""
+        fd, img_path = tempfile.mkstemp(suffix=".png", dir=tmp_dir)
+        os.close(fd)
+        try:
+            cv.imwrite(img_path, image)
+            return self.recognize(img_path, language, psm)
+        finally:
+            os.unlink(img_path)
+
+    def recognize_batch(self, img_paths: list[str], language: str) -> list[str]:
+        """Return the hOCR of every image of img_paths, in the same order."""
+        return [self.recognize(img_path, language) for img_path in img_paths]
+
+    def close(self) -> None:
+        """Release the resources held by the engine."""
+
+
+def encode_pgm(image: np.ndarray) -> bytes:
+    """Encode a grayscale image as binary PGM, which tesseract reads without any decompression."""
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    return b"P5\n%d %d\n255\n" % (image.shape[1], image.shape[0]) + image.tobytes()
+
+
+class TesseractCLIEngine(OCREngine):
+    """
+    Spawn one tesseract process per image, the historical behaviour.
+
+    With the "stdin" transport, images held in memory are piped to tesseract
+    as PGM instead of being written to a temporary file.
+    """
+
+    name = "cli"
+    omp_configurable = True
+
+    def __init__(self, tesseract_path: str = "tesseract", psm: int = DEFAULT_PSM, transport: str = "file"):
+        self.tesseract_path = tesseract_path
+        self.psm = psm
+        self.transport = transport
+        self.env: Optional[dict[str, str]] = None
+        self._version: Optional[str] = None
+
+    def set_omp_threads(self, omp_threads: int) -> None:
+        self.env = dict(os.environ, OMP_THREAD_LIMIT=str(omp_threads))
+
+    def version(self) -> str:
+        if self._version is None:
+            # Older tesseract versions print their version on stderr
+            output = subprocess.run(
+                [self.tesseract_path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            ).stdout.decode("utf-8", "replace")
+            self._version = f"{self.name} {output.splitlines()[0] if output else 'unknown'}"
+        return self._version
+
+    def _run(self, source: str, language: str, psm: Optional[int], input_data: Optional[bytes] = None,
+             image_count: int = 1) -> str:
+        tess_cmd = [
+            self.tesseract_path, source, "stdout", "-l", language, "--psm", str(psm or self.psm), "hocr"
+        ]
+        try:
+            return subprocess.check_output(
+                tess_cmd,
+                input=input_data,
+                stderr=subprocess.DEVNULL,
+                env=self.env,
+                timeout=self.timeout and self.timeout * image_count
+            ).decode('utf-8')
+        except subprocess.TimeoutExpired as e:
+            raise OCRError(f"tesseract timed out after {e.timeout:g}s on {source}") from e
+        except subprocess.CalledProcessError as e:
+            raise OCRError(f"tesseract exited with code {e.returncode} on {source}") from e
+
+    def recognize(self, img_path: str, language: str, psm: Optional[int] = None) -> str:
+        return self._run(str(img_path), language, psm)
+
+    def recognize_array(self, image: np.ndarray, language: str, psm: Optional[int] = None,
+                        tmp_dir: Optional[str] = None) -> str:
+        if self.transport == "stdin":
+            return self._run("stdin", language, psm, encode_pgm(image))
+        return super().recognize_array(image, language, psm, tmp_dir)
+
+    def recognize_batch(self, img_paths: list[str], language: str) -> list[str]:
+        """
+        OCR all the images with a single tesseract process.
+
+        The images are given to tesseract as a list file, the multi-page hOCR
+        it outputs is then split back per ocr_page.
+        """
+        if len(img_paths) < 2:
+            return super().recognize_batch(img_paths, language)
+        fd, list_path = tempfile.mkstemp(suffix=".txt", text=True)
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as ofile:
+                ofile.write("\n".join(str(img_path) for img_path in img_paths) + "\n")
+            html_content = self._run(list_path, language, None, image_count=len(img_paths))
+        finally:
+            os.unlink(list_path)
+        return split_hocr_pages(html_content, img_paths)
+
+
+def split_hocr_pages(html_content: str, img_paths: list[str]) -> list[str]:
+    """Split a multi-page hOCR document into one hOCR string per image of img_paths."""
+    matches = list(HOCR_PAGE_RE.finditer(html_content))
+    if len(matches) != len(img_paths):
+        raise ValueError(f"Expected {len(img_paths)} hOCR pages, got {len(matches)}")
+    bounds = [match.start() for match in matches] + [len(html_content)]
+    pages = [html_content[bounds[idx]:bounds[idx + 1]] for idx in range(len(matches))]
+    by_image = {match.group(1): page for match, page in zip(matches, pages)}
+    if len(by_image) == len(img_paths) and all(str(img_path) in by_image for img_path in img_paths):
+        return [by_image[str(img_path)] for img_path in img_paths]
+    # Paths were rewritten by tesseract, pages come in the list file order
+    return pages
+
+
+# Seconds a tesserocr worker may take past the timeout of Recognize(), which is only checked between words
+WORKER_GRACE = 5.
+
+
+def _tesserocr_worker(conn: Any) -> None:
+    """
+    Serve the recognitions sent on conn in a child process, with one Tesseract
+    API handle per language and psm, so a crash of libtesseract only kills it.
+    """
+    tesserocr = _import_tesserocr()
+    apis: dict[tuple[str, int], Any] = {}
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        language, psm, image, img_path, timeout = request
+        try:
+            if (language, psm) not in apis:
+                apis[(language, psm)] = tesserocr.PyTessBaseAPI(lang=language, psm=psm)
+            api = apis[(language, psm)]
+            if image is not None:
+                api.SetImageBytes(image.tobytes(), image.shape[1], image.shape[0], 1, image.shape[1])
+            else:
+                api.SetImageFile(img_path)
+            # Recognize() gives up after the timeout in milliseconds and returns False
+            if not api.Recognize(int(timeout * 1000) if timeout else 0):
+                raise OCRError("tesserocr failed or timed out")
+            conn.send((True, api.GetHOCRText(0)))
+        except Exception as e:
+            conn.send((False, str(e)))
+    for api in apis.values():
+        api.End()
+
+
+class _TesserocrWorker:
+    """A child process running _tesserocr_worker."""
+
+    def __init__(self):
+        # Spawned, a forked child would inherit the locks held by the other threads
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_tesserocr_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def recognize(self, request: tuple, timeout: Optional[float]) -> tuple[bool, str]:
+        """Send a request, raises EOFError when the worker died and TimeoutError when it does not answer."""
+        self.conn.send(request)
+        if not self.conn.poll(timeout + WORKER_GRACE if timeout else None):
+            raise TimeoutError
+        return self.conn.recv()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(WORKER_GRACE)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class TesserocrEngine(OCREngine):
+    """
+    Keep initialized Tesseract API handles alive and reuse them across images.
+
+    The handles live in worker processes, created on demand, one per
+    concurrent recognition. A worker keeps a handle per language and psm,
+    so the traineddata model is loaded once instead of once per image.
+    A worker crashing or stuck past the timeout is killed, only its image
+    fails, and a new worker takes its place.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self, psm: int = DEFAULT_PSM):
+        self._tesserocr = _import_tesserocr()
+        if self._tesserocr is None:
+            raise RuntimeError("tesserocr is not installed")
+        self.psm = psm
+        self._lock = threading.Lock()
+        self._free: list[_TesserocrWorker] = []
+        self._workers: list[_TesserocrWorker] = []
+
+    def version(self) -> str:
+        return f"{self.name} {self._tesserocr.tesseract_version().splitlines()[0]}"
+
+    def _acquire(self) -> _TesserocrWorker:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        worker = _TesserocrWorker()
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _recognize(self, language: str, psm: Optional[int], image: Optional[np.ndarray],
+                   img_path: Optional[str], source: str) -> str:
+        worker = self._acquire()
+        try:
+            ok, result = worker.recognize((language, psm or self.psm, image, img_path, self.timeout), self.timeout)
+        except (EOFError, OSError, TimeoutError) as e:
+            with self._lock:
+                self._workers.remove(worker)
+            worker.kill()
+            raise OCRError(
+                f"tesserocr worker {'timed out' if isinstance(e, TimeoutError) else 'crashed'} on {source}"
+            ) from e
+        with self._lock:
+            self._free.append(worker)
+        if not ok:
+            raise OCRError(f"{result} on {source}")
+        return result
+
+    def recognize(self, img_path: str, language: str, psm: Optional[int] = None) -> str:
+        return self._recognize(language, psm, None, str(img_path), img_path)
+
+    def recognize_array(self, image: np.ndarray, language: str, psm: Optional[int] = None,
+                        tmp_dir: Optional[str] = None) -> str:
+        return self._recognize(language, psm, np.ascontiguousarray(image, dtype=np.uint8), None, "image")
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers, self._free = self._workers, [], []
+        for worker in workers:
+            worker.close()
+
+
+def load_recording(path: Union[Path, str]) -> dict[str, str]:
+    """Read the image key to hOCR entries of a recording written by RecordingEngine."""
+    recording = {}
+    with open(path, "r", encoding="utf8") as ifile:
+        for line in ifile:
+            if line.strip():
+                entry = json.loads(line)
+                recording[entry["key"]] = entry["hocr"]
+    return recording
+
+
+def recording_key(image: np.ndarray, language: str, psm: int) -> str:
+    return OCRCache.image_key(image, language, psm)
+
+
+class FakeEngine(OCREngine):
+    """
+    Deterministic engine which needs no tesseract, to benchmark the rest of the pipeline.
+
+    Every recognition waits latency seconds, then returns the hOCR recorded
+    for the same image and settings when a replay recording is given, else
+    one synthetic line per text band of the image, made of the size of the
+    band and a hash of its pixels. A band reads the same alone as in a
+    mosaic, so every OCR mode gives the same text.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0., replay_path: Optional[Union[Path, str]] = None, psm: int = DEFAULT_PSM):
+        self.latency = latency
+        self.psm = psm
+        self.replay = load_recording(replay_path) if replay_path else {}
+
+    def recognize(self, img_path: str, language: str, psm: Optional[int] = None) -> str:
+        return self.recognize_array(ImagePrep.read_gray(img_path), language, psm)
+
+    def recognize_array(self, image: np.ndarray, language: str, psm: Optional[int] = None,
+                        tmp_dir: Optional[str] = None) -> str:
+        if self.timeout and self.latency > self.timeout:
+            time.sleep(self.timeout)
+            raise OCRError(f"fake engine timed out after {self.timeout:g}s")
+        if self.latency > 0:
+            time.sleep(self.latency)
+        key = recording_key(image, language, psm or self.psm)
+        if key in self.replay:
+            return self.replay[key]
+        lines = []
+        # Every run of text rows is a line, small runs are not joined to their neighbours as they may be
+        # joined to another image of a mosaic
+        for top, bottom in ImagePrep.split_lines(image, margin=0, min_height_ratio=0):
+            left, band_top, right, band_bottom = ImagePrep.text_bbox(image[top:bottom])
+            band = image[top:bottom, left:right]
+            text = html.escape(f"{band.shape[1]}x{band.shape[0]}-{OCRCache.image_key(band)[:8]}")
+            lines.append((
+                "<span class='ocr_line' title=\"bbox {0} {1} {2} {3}\">"
+                "<span class='ocrx_word' title='bbox {0} {1} {2} {3}; x_wconf 90'>{4}</span></span>"
+            ).format(left, top + band_top, right, top + band_bottom, text))
+        return "<div class='ocr_page' title='bbox 0 0 {} {}'>{}</div>\n".format(
+            image.shape[1], image.shape[0], "".join(lines)
+        )
+
+
+class RecordingEngine(OCREngine):
+    """Wrap an engine and append every hOCR it returns to a recording file, to be replayed by FakeEngine."""
+
+    def __init__(self, engine: OCREngine, path: Union[Path, str]):
+        self.engine = engine
+        self.name = engine.name
+        self.timeout = engine.timeout
+        self.psm = engine.psm
+        self.omp_configurable = engine.omp_configurable
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def version(self) -> str:
+        return self.engine.version()
+
+    def set_omp_threads(self, omp_threads: int) -> None:
+        self.engine.set_omp_threads(omp_threads)
+
+    def _record(self, image: np.ndarray, language: str, psm: Optional[int], html_content: str) -> None:
+        entry = json.dumps({"key": recording_key(image, language, psm or self.psm), "hocr": html_content})
+        with self._lock:
+            with open(self.path, "a", encoding="utf8") as ofile:
+                ofile.write(entry + "\n")
+
+    def recognize(self, img_path: str, language: str, psm: Optional[int] = None) -> str:
+        html_content = self.engine.recognize(img_path, language, psm)
+        self._record(ImagePrep.read_gray(img_path), language, psm, html_content)
+        return html_content
+
+    def recognize_array(self, image: np.ndarray, language: str, psm: Optional[int] = None,
+                        tmp_dir: Optional[str] = None) -> str:
+        html_content = self.engine.recognize_array(image, language, psm, tmp_dir)
+        self._record(image, language, psm, html_content)
+        return html_content
+
+    def recognize_batch(self, img_paths: list[str], language: str) -> list[str]:
+        html_contents = self.engine.recognize_batch(img_paths, language)
+        for img_path, html_content in zip(img_paths, html_contents):
+            self._record(ImagePrep.read_gray(img_path), language, None, html_content)
+        return html_contents
+
+    def close(self) -> None:
+        self.engine.close()
+
+
+ENGINES = ("auto", "tesserocr", "cli", "fake")
+
+
+def get_engine(name: str = "auto", tesseract_path: str = "tesseract", transport: str = "file",
+               fake_latency: float = 0., replay_path: Optional[Union[Path, str]] = None) -> OCREngine:
+    """
+    Build the OCR engine called name.
+
+    "auto" uses the in-process tesserocr engine when it is installed
+    and falls back to the tesseract binary otherwise.
+    """
+    if name in ("auto", "tesserocr"):
+        try:
+            return TesserocrEngine()
+        except RuntimeError:
+            if name == "tesserocr":
+                raise
+    if name == "fake":
+        return FakeEngine(fake_latency, replay_path)
+    return TesseractCLIEngine(tesseract_path, transport=transport)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import functools
+import threading
+import time
+from multiprocessing.dummy import Pool as ThreadPool
+from typing import Any, Callable, Optional
+
+# Number of jobs every worker runs for each calibration measure
+CALIBRATION_JOBS_PER_WORKER = 2
+
+
+class OCRScheduler:
+    """
+    Split the CPU threads between concurrent OCR workers and the OpenMP
+    threads of each tesseract call, so that workers x omp_threads never
+    oversubscribes the machine.
+
+    With omp_threads None the split is calibrated: the first jobs are run
+    with every candidate split, and the one with the best images/sec is kept.
+
+    The workers are shared by every concurrent run(), as when several videos
+    are OCRed at once, so they never OCR more than workers jobs together.
+    Calibration waits for the running jobs and pauses the other runs.
+    """
+
+    def __init__(self, threads: int, omp_threads: Optional[int], apply_omp_threads: Callable[[int], None],
+                 omp_configurable: bool = True, log: Optional[Any] = None):
+        self.threads = max(1, threads)
+        self.apply_omp_threads = apply_omp_threads
+        self.log = log
+        self._jobs = threading.Condition()
+        self._active = 0
+        self._limit = self.threads
+        self._calibrating = False
+        if omp_threads is None and not omp_configurable:
+            omp_threads = 1
+        self.split: Optional[tuple[int, int]] = None
+        if omp_threads is not None:
+            self.set_split(max(1, self.threads // omp_threads), omp_threads)
+
+    def set_split(self, workers: int, omp_threads: int) -> None:
+        with self._jobs:
+            self.split = (workers, omp_threads)
+            self._limit = workers
+            self.apply_omp_threads(omp_threads)
+            self._jobs.notify_all()
+
+    def candidates(self) -> list[tuple[int, int]]:
+        """Every (workers, omp_threads) split of the threads, with power of two omp_threads."""
+        candidates = []
+        omp_threads = 1
+        while omp_threads <= self.threads:
+            candidates.append((self.threads // omp_threads, omp_threads))
+            omp_threads *= 2
+        return candidates
+
+    def _run_pool(self, func: Callable[[Any], Any], jobs: list[Any], workers: int) -> list[Any]:
+        pool = ThreadPool(workers)
+        results = pool.map(func, jobs)
+        pool.close()
+        pool.join()
+        return results
+
+    def _shared(self, func: Callable[[Any], Any], job: Any) -> Any:
+        # Runs func once one of the workers shared by every run() is free
+        with self._jobs:
+            self._jobs.wait_for(lambda: not self._calibrating and self._active < self._limit)
+            self._active += 1
+        try:
+            return func(job)
+        finally:
+            with self._jobs:
+                self._active -= 1
+                self._jobs.notify_all()
+
+    def _start_calibration(self) -> bool:
+        # Only one run calibrates, once no job of the other runs is OCRing
+        with self._jobs:
+            if self.split is not None or self._calibrating:
+                return False
+            self._calibrating = True
+            self._jobs.wait_for(lambda: self._active == 0)
+            return True
+
+    def _calibrate(self, func: Callable[[Any], Any], jobs: list[Any], sizes: list[int]) -> list[Any]:
+        results: list[Any] = []
+        measures = []
+        for workers, omp_threads in self.candidates():
+            window = slice(len(results), len(results) + workers * CALIBRATION_JOBS_PER_WORKER)
+            self.apply_omp_threads(omp_threads)
+            start = time.perf_counter()
+            results += self._run_pool(func, jobs[window], workers)
+            speed = sum(sizes[window]) / max(time.perf_counter() - start, 1e-6)
+            measures.append((speed, workers, omp_threads))
+            if self.log:
+                self.log.debug(f" + Scheduler - {workers} workers x {omp_threads} threads: {speed:.2f} images/sec")
+        _, workers, omp_threads = max(measures)
+        self.set_split(workers, omp_threads)
+        if self.log:
+            self.log.info(f" + Scheduler - Using {workers} OCR workers x {omp_threads} threads")
+        return results
+
+    def run(self, func: Callable[[Any], Any], jobs: list[Any], sizes: Optional[list[int]] = None) -> list[Any]:
+        """
+        Map func over jobs, results come in the jobs order.
+
+        sizes holds the number of images of every job, to measure images/sec.
+        """
+        sizes = sizes or [1] * len(jobs)
+        results: list[Any] = []
+        needed = sum(workers * CALIBRATION_JOBS_PER_WORKER for workers, _ in self.candidates())
+        # Without enough work to calibrate, jobs run on the threads with 1 OpenMP thread each
+        if self.split is None and needed <= len(jobs) and self._start_calibration():
+            try:
+                results = self._calibrate(func, jobs, sizes)
+            finally:
+                with self._jobs:
+                    self._calibrating = False
+                    self._jobs.notify_all()
+        workers = self.split[0] if self.split is not None else self.threads
+        return results + self._run_pool(functools.partial(self._shared, func), jobs[len(results):], workers)
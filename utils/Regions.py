@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import NamedTuple, Union
+
+# Wrappings of the text OCRed in a region, a style can also be any text holding "{text}"
+STYLES = {
+    "default": "{text}",
+    # Yellow in srt, at the top of the screen in ass
+    "alt": "<font color=\"#ffff00\">{text}</font>",
+    "italic": "<i>{text}</i>",
+}
+
+
+class Region(NamedTuple):
+    """
+    A box of the video filtered and OCRed on its own, its screenlog and
+    images go to the dir named after it.
+
+    The box is width x height, its bottom is y rows above the bottom of the
+    video and its left column is x, -1 to center it. Scene changes are
+    detected on a part of the box starting at detection_top of its height.
+    """
+    name: str
+    width: int
+    height: int
+    y: int = 0
+    x: int = -1
+    white_thresh: Union[int, list] = 230
+    black_thresh: Union[int, list] = 80
+    detection_top: float = 1 / 2
+    style: str = "default"
+
+    def left(self, video_width: int) -> int:
+        return int((video_width - self.width) / 2) if self.x < 0 else self.x
+
+    def top(self, video_height: int) -> int:
+        return video_height - (self.y + self.height)
+
+    def wrap(self, text: str) -> str:
+        return STYLES.get(self.style, self.style).replace("{text}", text)
+
+
+def default_regions(width: int, height: int, cropbox_y: int = 0, cropbox_alt_y: int = -1,
+                    white_thresh: Union[int, list] = 230, black_thresh: Union[int, list] = 80) -> list[Region]:
+    """The default box, and the alt box when cropbox_alt_y is not -1, as given on the command line."""
+    regions = [Region("default", int(width), int(height), int(cropbox_y), -1, white_thresh, black_thresh)]
+    if int(cropbox_alt_y) >= 0:
+        regions.append(Region(
+            "alt", int(width), int(height), int(cropbox_alt_y), -1, white_thresh, black_thresh, 1 / 2 - 1 / 2.7, "alt"
+        ))
+    return regions
+
+
+def load_regions(path: Union[Path, str], base: Region) -> list[Region]:
+    """
+    Read the regions of a JSON file, a list of objects with the fields of
+    Region. The fields left out take their value in base.
+    """
+    with open(path, "r", encoding="utf8") as ifile:
+        entries = json.load(ifile)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must hold a non-empty list of regions")
+    regions = []
+    for entry in entries:
+        unknown = set(entry) - set(Region._fields)
+        if unknown:
+            raise ValueError(f"Unknown region fields {sorted(unknown)} in {path}")
+        region = base._replace(**entry)
+        if not region.name or region.name != Path(region.name).name or region.name.startswith("chunk"):
+            raise ValueError(f"Region name \"{region.name}\" cannot be used as a directory name")
+        if region.style not in STYLES and "{text}" not in region.style:
+            raise ValueError(f"Region style \"{region.style}\" is neither one of {list(STYLES)} nor holds {{text}}")
+        if region.width <= 0 or region.height <= 0:
+            raise ValueError(f"Region \"{region.name}\" has a size of {region.width}x{region.height}")
+        if not 0 < region.detection_top < 1:
+            raise ValueError(f"Region \"{region.name}\" has a detection_top of {region.detection_top}, not in (0, 1)")
+        regions.append(region)
+    if len({region.name for region in regions}) != len(regions):
+        raise ValueError(f"Region names are not unique in {path}")
+    return regions
+
+
+def check_regions(regions: list[Region], video_width: int, video_height: int) -> None:
+    """Raise a ValueError naming the first region that does not fit in the video."""
+    for region in regions:
+        left, top = region.left(video_width), region.top(video_height)
+        if (region.width <= 0 or region.height <= 0 or left < 0 or top < 0
+                or left + region.width > video_width or top + region.height > video_height):
+            raise ValueError(
+                f"Region \"{region.name}\" of {region.width}x{region.height} at ({left}, {top})"
+                f" does not fit in the {video_width}x{video_height} video"
+            )
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Union
+
+import cv2 as cv
+import numpy as np
+
+# Downscale factor of the bitmask, small enough to tell apart a one letter change
+HASH_SCALE = 4
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint16)
+
+
+def scene_hash(img_path: Union[Path, str], scale: int = HASH_SCALE) -> tuple[tuple[int, int], np.ndarray]:
+    """
+    Compute the perceptual hash of a binarized scene image.
+
+    The image is downscaled by scale and every cell holding some text
+    becomes a set bit, packed 8 per byte. The image shape is returned with the
+    hash because only images of the same shape are compared.
+    """
+    image = cv.imread(str(img_path), cv.IMREAD_GRAYSCALE)
+    if image is None:
+        raise IOError(f"Can't read image {img_path}")
+    hash_size = (max(1, image.shape[1] // scale), max(1, image.shape[0] // scale))
+    small = cv.resize(image, hash_size, interpolation=cv.INTER_AREA)
+    return image.shape, np.packbits(small > 32)
+
+
+def group_hashes(hashes: list[tuple[tuple[int, int], np.ndarray]], threshold: int) -> list[int]:
+    """
+    Group near-duplicate hashes.
+
+    Each hash joins the closest earlier representative of the same shape within
+    threshold differing bits, or becomes a representative itself. Returns the
+    index of the representative of every hash.
+    """
+    groups = []
+    # Representatives of every image shape, as a stacked bit array and their indexes
+    representatives: dict[tuple[int, int], tuple[np.ndarray, list[int]]] = {}
+    for idx, (shape, bits) in enumerate(hashes):
+        rep_bits, rep_indexes = representatives.get(shape, (None, []))
+        if rep_bits is not None:
+            distances = POPCOUNT[np.bitwise_xor(rep_bits, bits)].sum(axis=1)
+            closest = int(np.argmin(distances))
+            if distances[closest] <= threshold:
+                groups.append(rep_indexes[closest])
+                continue
+            rep_bits = np.vstack([rep_bits, bits])
+        else:
+            rep_bits = bits[np.newaxis]
+        representatives[shape] = (rep_bits, rep_indexes + [idx])
+        groups.append(idx)
+    return groups
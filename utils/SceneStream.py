@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+from pathlib import Path
+from typing import Optional, Union
+
+SCENE_ROW_RE = re.compile(r"(\d+),(\d),(\d),\"([^\"]*)\"")
+VIDEO_INFO_RE = re.compile(r"\[Video Informations\]\nfps=(\d+\.\d+)\nframe_count=(\d+)")
+
+Scene = tuple[int, int, str]
+SceneRow = tuple[int, int, int, str]
+
+
+class SceneBuilder:
+    """
+    Build (start, end, image path) scenes from the rows of a scene change log.
+
+    Rows may be fed out of order, as the filter logs frames from several
+    threads. A row is only used once no row older than reorder_window frames
+    before the newest one can still come, so scenes are released while the
+    log is being written.
+    """
+
+    def __init__(self, base_dir: Union[Path, str], reorder_window: int = 0):
+        self.base_dir = base_dir
+        self.reorder_window = reorder_window
+        self._rows: dict[int, tuple[int, int, str]] = {}
+        self._max_frame = -1
+        self._first = True
+        self._start: Optional[tuple[int, str]] = None
+
+    def feed(self, frame: int, is_start: int, is_end: int, img_path: str) -> None:
+        self._rows[frame] = (is_start, is_end, img_path)
+        self._max_frame = max(self._max_frame, frame)
+
+    def feed_text(self, text: str) -> None:
+        """Feed every scene change row found in text."""
+        for match in SCENE_ROW_RE.finditer(text):
+            self.feed(int(match.group(1)), int(match.group(2)), int(match.group(3)), match.group(4))
+
+    def ready(self) -> list[Scene]:
+        """Return the scenes which can't be changed by rows still to come."""
+        return self._settle(self._max_frame - self.reorder_window)
+
+    def finish(self, last_frame: int) -> list[Scene]:
+        """Return the remaining scenes once the log is complete, an unfinished scene ends at last_frame."""
+        scenes = self._settle(self._max_frame)
+        if self._start is not None:
+            scenes.append((self._start[0], last_frame, self._start[1]))
+            self._start = None
+        return scenes
+
+    def _settle(self, limit: int) -> list[Scene]:
+        scenes = []
+        for frame in sorted(frame for frame in self._rows if frame <= limit):
+            is_start, is_end, img_path = self._rows.pop(frame)
+            img_path = os.path.join(self.base_dir, img_path)
+            if self._first and not is_start and is_end:
+                # Case where scenechange missed first scene ??? (has happened)
+                pass
+            elif is_start and is_end:
+                # Case where the scene is one frame long (should not happen too often)
+                scenes.append((frame, frame, img_path))
+            elif is_start:
+                self._start = (frame, img_path)
+            elif is_end and self._start is not None:
+                scenes.append((self._start[0], frame, self._start[1]))
+                self._start = None
+            self._first = False
+        return scenes
+
+
+class SceneLogFollower:
+    """
+    Read the SceneChanges.jsonl journal while the filter is still appending events to it.
+
+    The first record holds the fps and frame count of the video, every
+    following one a scene change row.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.fps: Optional[float] = None
+        self.frame_count: Optional[int] = None
+        self._offset = 0
+        self._buffer = ""
+
+    def poll(self) -> list[SceneRow]:
+        """Return the (frame, is_start, is_end, image) rows written since the last call."""
+        if not self.path.is_file():
+            return []
+        with open(self.path, "r") as ifile:
+            ifile.seek(self._offset)
+            self._buffer += ifile.read()
+            self._offset = ifile.tell()
+        end = self._buffer.rfind("\n") + 1
+        lines, self._buffer = self._buffer[:end].splitlines(), self._buffer[end:]
+        rows = []
+        for line in lines:
+            event = json.loads(line)
+            if "frame" in event:
+                rows.append((event["frame"], event["is_start"], event["is_end"], event["subimage"]))
+            else:
+                self.fps = float(event["fps"])
+                self.frame_count = int(event["frame_count"])
+        return rows
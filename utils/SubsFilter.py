@@ -0,0 +1,843 @@
+from __future__ import annotations
+
+import atexit
+import functools
+import json
+import os
+import re
+import shutil
+import threading
+from pathlib import Path, PurePath
+from typing import Any, NamedTuple, Optional, Union
+
+import cv2 as cv
+import numpy as np
+
+from utils.Regions import Region, check_regions, default_regions
+
+# Frames filtered on each side of a chunk, only its own frames are kept, the others are compared
+CHUNK_OVERLAP = 5
+
+# Presence pre-pass: downscaling of the boxes, white pixels near a dark one telling a box may hold
+# outlined text, distance in pixels of that dark one, and frames filtered around the ones that may
+PRESENCE_SCALE = 2
+PRESENCE_MIN_EDGES = 8
+PRESENCE_DARK_DISTANCE = 2
+PRESENCE_PADDING = 12
+
+SCENE_ROW_RE = re.compile(r'^(\d+),(\d+),(\d+),"([^"]*)"$', re.MULTILINE)
+SPAN_RE = re.compile(r"(\d+)-(\d+):(\d+)-(\d+)")
+
+
+class Chunk(NamedTuple):
+    """Frames [start, end) of a video logged by a chunk, which filters [filter_start, filter_end)."""
+    start: int
+    end: int
+    filter_start: int
+    filter_end: int
+
+
+def chunk_span(frame_count: int, chunk_count: int, chunk_id: int, overlap: int = CHUNK_OVERLAP) -> Chunk:
+    """Split frame_count frames into chunk_count equal chunks, return the one at chunk_id."""
+    start = frame_count * chunk_id // chunk_count
+    end = frame_count * (chunk_id + 1) // chunk_count
+    return Chunk(start, end, max(0, start - overlap), min(frame_count, end + overlap))
+
+
+def format_spans(spans: list[Chunk]) -> str:
+    return ";".join("{}-{}:{}-{}".format(*span) for span in spans)
+
+
+def parse_spans(spans: str) -> list[Chunk]:
+    return [Chunk(*map(int, span)) for span in SPAN_RE.findall(spans)]
+
+
+def presence_spans(ranges: list[tuple[int, int]], frame_count: int, padding: int = PRESENCE_PADDING,
+                   overlap: int = CHUNK_OVERLAP) -> list[Chunk]:
+    """
+    Turn the [start, end) ranges that may hold text into the spans to filter,
+    widened by padding frames and merged when their filtered frames touch.
+    """
+    spans: list[Chunk] = []
+    for start, end in ranges:
+        start, end = max(0, start - padding), min(frame_count, end + padding)
+        if spans and start - overlap <= spans[-1].filter_end:
+            start = spans[-1].start
+            spans.pop()
+        spans.append(Chunk(start, end, max(0, start - overlap), min(frame_count, end + overlap)))
+    return spans
+
+
+def split_spans(spans: list[Chunk], group_count: int, overlap: int = CHUNK_OVERLAP) -> list[list[Chunk]]:
+    """
+    Split consecutive spans into at most group_count groups logging about as
+    many frames, a span is cut in two where a group ends.
+    """
+    total = sum(span.end - span.start for span in spans)
+    groups: list[list[Chunk]] = [[]]
+    done = 0
+    for span in spans:
+        start = span.start
+        while start < span.end:
+            group_end = total * len(groups) // group_count
+            end = span.end
+            if len(groups) < group_count:
+                end = min(span.end, start + max(1, group_end - done))
+            groups[-1].append(Chunk(
+                start, end,
+                span.filter_start if start == span.start else max(span.filter_start, start - overlap),
+                span.filter_end if end == span.end else min(span.filter_end, end + overlap)
+            ))
+            done += end - start
+            start = end
+            if done >= group_end and len(groups) < group_count:
+                groups.append([])
+    return [group for group in groups if group]
+
+
+def has_text(luma: np.ndarray, white_thresh: int, black_thresh: int, min_edges: int = PRESENCE_MIN_EDGES,
+             dark_distance: int = PRESENCE_DARK_DISTANCE) -> bool:
+    """
+    Whether a box may hold outlined text: enough white pixels with a dark one
+    at most dark_distance pixels away in any direction. Antialiased, blurred
+    or compressed outlines fade through grey, so the dark pixel is seldom
+    right next to the white one.
+    """
+    white = luma >= white_thresh
+    if np.count_nonzero(white) < min_edges:
+        return False
+    dark = (luma < black_thresh).astype(np.uint8)
+    near_dark = cv.dilate(dark, np.ones((2 * dark_distance + 1, 2 * dark_distance + 1), dtype=np.uint8))
+    return np.count_nonzero(white & (near_dark > 0)) >= min_edges
+
+
+def luma_only(regions: list[Region]) -> bool:
+    """Whether the thresholds of every region apply to the luma, none of them being RGB."""
+    return all(type(region.white_thresh) is int and type(region.black_thresh) is int for region in regions)
+
+
+def presence_size(region: Region) -> tuple[int, int]:
+    """Width and height of the box of region in the presence pre-pass."""
+    return max(2, region.width // PRESENCE_SCALE // 2 * 2), max(2, region.height // PRESENCE_SCALE // 2 * 2)
+
+
+def boxes_have_text(luma: np.ndarray, regions: list[Region]) -> bool:
+    """Whether one of the presence boxes of the regions, stacked from the top left of luma, may hold text."""
+    top = 0
+    for region in regions:
+        width, height = presence_size(region)
+        if has_text(luma[top:top + height, :width], region.white_thresh, region.black_thresh):
+            return True
+        top += height
+    return False
+
+
+def write_screenlog(dir_: Union[Path, str], fps: float, frame_count: int, zero_pad: int,
+                    rows: dict[int, tuple[int, int, str]], spans: Optional[list[Chunk]] = None) -> None:
+    """Write the SceneChanges.csv of dir_ at once, rows are sorted by frame."""
+    # Written next to the final file then renamed, readers never see a partial screenlog
+    tmp_path = Path(dir_).joinpath("SceneChanges.csv.tmp")
+    with open(tmp_path, "w") as ofile:
+        ofile.write("[Video Informations]\nfps={:.2f}\nframe_count={}\n".format(fps, frame_count))
+        if spans is not None:
+            ofile.write("spans={}\n".format(format_spans(spans)))
+        ofile.write("\n[Scene Informations]\n")
+        ofile.write("frame,is_start,is_end,subimage\n")
+        ofile.write("".join(
+            "%0*d,%d,%d,\"%s\"\n" % (zero_pad, n, is_start, is_end, img)
+            for n, (is_start, is_end, img) in sorted(rows.items())
+        ))
+    os.replace(tmp_path, Path(dir_).joinpath("SceneChanges.csv"))
+
+
+def read_chunk_log(dir_: Union[Path, str]) -> tuple[float, int, list[Chunk], dict[int, tuple[int, int, str]]]:
+    """Read the SceneChanges.csv written by a chunk, returns its fps, frame count, spans and rows."""
+    with open(Path(dir_).joinpath("SceneChanges.csv"), "r") as ifile:
+        video_data, scene_data = ifile.read().split("[Scene Informations]\n", 1)
+    fps, frame_count, spans = re.findall(r"fps=(\d+\.\d+)\nframe_count=(\d+)\nspans=(.*)\n", video_data)[0]
+    rows = {
+        int(n): (int(is_start), int(is_end), img) for n, is_start, is_end, img in SCENE_ROW_RE.findall(scene_data)
+    }
+    return float(fps), int(frame_count), parse_spans(spans), rows
+
+
+def read_screenlog_rows(dir_: Union[Path, str]) -> dict[int, tuple[int, int, str]]:
+    with open(Path(dir_).joinpath("SceneChanges.csv"), "r") as ifile:
+        scene_data = ifile.read().split("[Scene Informations]\n", 1)[1]
+    return {
+        int(n): (int(is_start), int(is_end), img) for n, is_start, is_end, img in SCENE_ROW_RE.findall(scene_data)
+    }
+
+
+def merge_chunk_logs(track_dir: Union[Path, str], chunk_count: int) -> list[int]:
+    """
+    Merge the screenlogs of the chunk<id> dirs of track_dir into its own SceneChanges.csv.
+
+    Every frame is taken from the chunk it belongs to, its image is moved to
+    track_dir. Returns the frames of the overlaps where a neighbour chunk
+    disagrees, the first and last frames a chunk filtered are not compared
+    since scene detection lacks their previous or next frame.
+    """
+    track_dir = Path(track_dir)
+    logs = [read_chunk_log(track_dir.joinpath(f"chunk{chunk_id}")) for chunk_id in range(chunk_count)]
+    fps, frame_count = logs[0][0], logs[0][1]
+    rows: dict[int, tuple[int, int, str]] = {}
+    owned = set()
+    for chunk_id, (_, _, spans, chunk_rows) in enumerate(logs):
+        chunk_dir = track_dir.joinpath(f"chunk{chunk_id}")
+        for span in spans:
+            owned.update(range(span.start, span.end))
+        for n, row in chunk_rows.items():
+            if any(span.start <= n < span.end for span in spans):
+                rows[n] = row
+                if row[2]:
+                    shutil.move(str(chunk_dir.joinpath(row[2])), str(track_dir.joinpath(row[2])))
+
+    mismatches = set()
+    for _, _, spans, chunk_rows in logs:
+        for span in spans:
+            compared = [
+                n for n in range(span.filter_start + 1, span.filter_end - 1)
+                if not span.start <= n < span.end and n in owned
+            ]
+            for n in compared:
+                theirs, ours = rows.get(n), chunk_rows.get(n)
+                if (theirs is None) != (ours is None) or (theirs is not None and theirs[:2] != ours[:2]):
+                    mismatches.add(n)
+
+    write_screenlog(track_dir, fps, frame_count, len(str(frame_count)), rows)
+    for chunk_id in range(chunk_count):
+        shutil.rmtree(track_dir.joinpath(f"chunk{chunk_id}"), ignore_errors=True)
+    return sorted(mismatches)
+
+
+def upscale_factors(supersampling: int, resampler: str, width: int, height: int) -> tuple[float, float]:
+    """
+    Return the supersampling factor of a width x height video, and the
+    resampling left after nnedi3 when it is the resampler.
+    """
+    if supersampling < 0:
+        if width / height > 16 / 9:
+            target_res = 1920
+            current_res = width
+        else:
+            target_res = 1080
+            current_res = height
+        if resampler == "nnedi3":
+            ss = target_res / current_res / 1.125
+        else:
+            ss = target_res / current_res
+    elif supersampling == 0:
+        ss = 1
+    else:
+        ss = supersampling
+
+    ssbis = 1
+    if resampler == "nnedi3" and ss != 1:
+        if ss - int(ss) > 0:
+            ss = int(ss / 2) * 2 + 2
+        else:
+            ss = int(ss / 2) * 2
+        if supersampling < 0:
+            ssbis = target_res / (current_res * ss)
+        else:
+            ssbis = supersampling / ss
+    return ss, ssbis
+
+
+def track_dirs(source: str, output_dir: Union[Path, str], names: list[str],
+               chunk_dir: Optional[str] = None) -> list[Path]:
+    """Create the output dirs of the regions, output_dir/<video name>/<region name>, or their chunk_dir subdirs."""
+    video_dir = Path(output_dir).joinpath(PurePath(source).name)
+    dirs = [video_dir.joinpath(name) for name in names]
+    if chunk_dir is not None:
+        dirs = [dir_.joinpath(chunk_dir) for dir_ in dirs]
+    for dir_ in dirs:
+        dir_.mkdir(parents=True, exist_ok=True)
+    return dirs
+
+
+class SceneLogWriter:
+    """
+    Collect the scene changes logged by the FrameEval callbacks, which run
+    on several VapourSynth threads in no particular order.
+
+    Events are appended by batches to SceneChanges.jsonl, which can be
+    followed while the clip is processed. Once every frame has been seen,
+    or at exit, SceneChanges.csv is written at once, sorted by frame.
+
+    With spans, only their filtered frames are processed, one after the
+    other, the frames given to frame_done are numbered in that order.
+    """
+
+    def __init__(self, dir_: Union[Path, str], fps: float, num_frames: int, zero_pad: int, batch_size: int = 64,
+                 spans: Optional[list[Chunk]] = None):
+        self.dir_ = Path(dir_)
+        self.fps = fps
+        self.num_frames = num_frames
+        self.zero_pad = zero_pad
+        self.batch_size = batch_size
+        self.spans = spans
+        self.frame_map: Optional[list[int]] = None
+        if spans is not None:
+            self.frame_map = [n for span in spans for n in range(span.filter_start, span.filter_end)]
+        self.frames_expected = num_frames if spans is None else len(self.frame_map)
+        self.lock = threading.Lock()
+        self.rows: dict[int, tuple[int, int, str]] = {}
+        self.pending: list[dict[str, Any]] = []
+        self.frames_seen: set[int] = set()
+        self.finished = False
+        self.journal = open(self.dir_.joinpath("SceneChanges.jsonl"), "w")
+        self.journal.write(json.dumps({"fps": self.fps, "frame_count": self.num_frames}) + "\n")
+        self.journal.flush()
+        atexit.register(self.finish)
+
+    def video_frame(self, n: int) -> int:
+        return n if self.frame_map is None else self.frame_map[n]
+
+    def image_name(self, n: int) -> str:
+        return "%0*d.png" % (self.zero_pad, self.video_frame(n))
+
+    def frame_done(self, n: int, is_start: Optional[int] = None, is_end: Optional[int] = None, img: str = "") -> None:
+        """Mark frame n as processed, with its scene change flags and image when it is one."""
+        n = self.video_frame(n)
+        with self.lock:
+            if self.finished:
+                return
+            if is_start is not None and n not in self.rows:
+                self.rows[n] = (is_start, is_end, img)
+                self.pending.append({"frame": n, "is_start": is_start, "is_end": is_end, "subimage": img})
+                if len(self.pending) >= self.batch_size:
+                    self._flush_journal()
+            self.frames_seen.add(n)
+            last_frame = len(self.frames_seen) == self.frames_expected
+        if last_frame:
+            self.finish()
+
+    def _flush_journal(self) -> None:
+        self.journal.write("".join(json.dumps(event) + "\n" for event in self.pending))
+        self.journal.flush()
+        self.pending = []
+
+    def finish(self) -> None:
+        """Write the sorted SceneChanges.csv, only the first call has an effect."""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            self._flush_journal()
+            self.journal.close()
+            write_screenlog(self.dir_, self.fps, self.num_frames, self.zero_pad, self.rows, self.spans)
+
+
+def minimum(x, y):
+    return min(x, y)
+
+
+def is_scene_change(props):
+    return (props._SceneChangePrev == 1 or props._SceneChangeNext == 1) and props.PlaneStatsMax > 1.
+
+
+def save_frame(frame, img_path):
+    v = cv.merge([
+        np.array(frame[i], copy=False) for i in reversed(range(frame.format.num_planes))
+    ])
+    cv.imwrite(str(img_path), v)
+
+
+def scene_log(n, f, clip, writer):
+    if is_scene_change(f[0].props):
+        nfn = ""
+        if f[0].props._SceneChangePrev == 1:
+            nfn = writer.image_name(n)
+            save_frame(f[1], writer.dir_.joinpath(nfn))
+        writer.frame_done(n, f[0].props._SceneChangePrev, f[0].props._SceneChangeNext, nfn)
+    else:
+        writer.frame_done(n)
+    return clip
+
+
+def capture_scene(n, f, writer):
+    # f[0] is the cleaned frame, f[1] holds the scene change props
+    nfn = writer.image_name(n)
+    save_frame(f[0], writer.dir_.joinpath(nfn))
+    writer.frame_done(n, f[1].props._SceneChangePrev, f[1].props._SceneChangeNext, nfn)
+    return f[0]
+
+
+def select_scene_frame(n, f, summary, capture, writer):
+    # Only the frames starting a scene need their cleaned image, they are rendered through capture
+    if is_scene_change(f.props):
+        if f.props._SceneChangePrev == 1:
+            return capture
+        writer.frame_done(n, f.props._SceneChangePrev, f.props._SceneChangeNext, "")
+    else:
+        writer.frame_done(n)
+    return summary
+
+
+class SubsFilter:
+    """
+    Filter graph extracting the subtitle images of a video, built with
+    the same parameters as the --arg list given to extract_subs_v1.vpy.
+
+    VapourSynth and its plugins are only imported once a SubsFilter is created.
+
+    With props_only, the output clip is a 1 pixel high summary of the scene
+    detection instead of the cleaned subtitles, cleaned frames are only
+    rendered to capture the images of the scene starts. native_detection
+    then also cleans and detects scenes on the box at the video resolution,
+    only the captured frames are supersampled and cleaned again.
+
+    Every region is filtered from the same source clip, by default the box
+    and alt box of width, height, cropbox_y and cropbox_alt_y.
+    """
+
+    def __init__(self, core: Any, width: int, height: int, cropbox_y: int = 0, cropbox_alt_y: int = -1,
+                 supersampling: int = -1, expand_ratio: int = 1, resampler: str = "sinc",
+                 white_thresh: Union[int, list] = 230, black_thresh: Union[int, list] = 80,
+                 detection_thresh: float = 0.03, props_only: bool = True,
+                 native_detection: bool = False, regions: Optional[list[Region]] = None):
+        import vapoursynth as vs
+        import havsfunc as haf
+        self.vs = vs
+        self.haf = haf
+        self.edi = None
+        if resampler == "nnedi3":
+            import edi_rpow2 as edi
+            self.edi = edi
+        self.core = core
+        self.dimension_crop_box = [int(width), int(height)]
+        self.height_crop_box = int(cropbox_y)
+        self.height_crop_box_alt = int(cropbox_alt_y)
+        self.supersampling = int(supersampling)
+        self.expand_ratio = int(expand_ratio)
+        self.mode_u = resampler
+        self.threshold_i = white_thresh
+        self.threshold_o = black_thresh
+        self.threshold_scd = float(detection_thresh)
+        self.props_only = props_only
+        self.native_detection = native_detection
+        self.regions = regions or default_regions(
+            width, height, cropbox_y, cropbox_alt_y, white_thresh, black_thresh
+        )
+
+    def upscale_factors(self, clip):
+        """Return the supersampling factor, and the resampling left after nnedi3 when it is used."""
+        return upscale_factors(self.supersampling, self.mode_u, clip.width, clip.height)
+
+    def resizing(self, clip, width, height, height2, ss, ssbis, left=None):
+        core = self.core
+        clip = core.std.CropAbs(
+            clip=clip, width=width, height=height,
+            left=int((clip.width - width) / 2) if left is None else left, top=clip.height - height2
+        )
+        if ss != 1:
+            if self.mode_u == "nnedi3" or self.mode_u == "waifu2x":
+                if self.mode_u == "nnedi3":
+                    clip = self.edi.nnedi3_rpow2(clip=clip, rfactor=ss)
+                else:
+                    clip = core.fmtc.bitdepth(clip=clip, bits=32)
+                    clip = core.w2xc.Waifu2x(clip=clip, scale=ss)
+                    if ssbis != 1:
+                        clip = core.fmtc.bitdepth(clip=clip, bits=16)
+                    else:
+                        clip = core.fmtc.bitdepth(clip=clip, bits=8)
+                if ssbis != 1:
+                    clip = core.fmtc.resample(clip=clip, scale=ssbis, kernel="sinc", taps=2)
+                    clip = core.fmtc.bitdepth(clip=clip, bits=8)
+            else:
+                clip = core.fmtc.resample(clip=clip, scale=ss, kernel="sinc", taps=2)
+                clip = core.fmtc.bitdepth(clip=clip, bits=8)
+        elif clip.format.bits_per_sample != 8:
+            clip = core.fmtc.bitdepth(clip=clip, bits=8)
+        return clip
+
+    def rgb_binarize(self, clip, threshold):
+        core, vs = self.core, self.vs
+        r = core.std.ShufflePlanes(clips=clip, planes=0, colorfamily=vs.GRAY)
+        g = core.std.ShufflePlanes(clips=clip, planes=1, colorfamily=vs.GRAY)
+        b = core.std.ShufflePlanes(clips=clip, planes=2, colorfamily=vs.GRAY)
+        for i in range(0, int(len(threshold) / 3)):
+            i = i * 3
+            x_ = "x " + str(threshold[i])
+            y_ = " >= y " + str(threshold[i + 1])
+            z_ = " >= or z " + str(threshold[i + 2])
+            rgb = core.std.Expr(
+                clips=[r, g, b],
+                expr=[x_ + y_ + z_ + " >= or 255 0 ?"]
+            )
+            if i == 0:
+                clipfin = rgb
+            else:
+                clipfin = core.std.Merge(clipfin, rgb)
+        clipfin = core.std.Binarize(clip=clipfin, threshold=1)
+        return clipfin
+
+    def cleaning(self, clip, blank, rect, e, threshold_i=None, threshold_o=None, native=False):
+        core, vs, haf = self.core, self.vs, self.haf
+        threshold_i = self.threshold_i if threshold_i is None else threshold_i
+        threshold_o = self.threshold_o if threshold_o is None else threshold_o
+        if type(threshold_i) is list or type(threshold_o) is list:
+            clip_rgb = core.fmtc.resample(clip=clip, css="444")
+            clip_rgb = core.fmtc.matrix(clip=clip_rgb, mat="709", col_fam=vs.RGB)
+            clip_rgb = core.fmtc.bitdepth(clip=clip_rgb, bits=8)
+
+        if type(threshold_i) is int and type(threshold_o) is int:
+            white_raw = core.std.Binarize(clip=clip, threshold=threshold_i)
+            bright_raw = core.std.Binarize(clip=clip, threshold=threshold_o)
+        elif type(threshold_i) is int and type(threshold_o) is list:
+            white_raw = core.std.ShufflePlanes(clips=clip, planes=0, colorfamily=vs.GRAY)
+            white_raw = core.std.Binarize(clip=white_raw, threshold=threshold_i)
+            bright_raw = self.rgb_binarize(clip_rgb, threshold_o)
+        elif type(threshold_i) is list and type(threshold_o) is int:
+            white_raw = self.rgb_binarize(clip_rgb, threshold_i)
+            bright_raw = core.std.ShufflePlanes(clips=clip, planes=0, colorfamily=vs.GRAY)
+            bright_raw = core.std.Binarize(clip=bright_raw, threshold=threshold_o)
+        else:
+            white_raw = self.rgb_binarize(clip_rgb, threshold_i)
+            bright_raw = self.rgb_binarize(clip_rgb, threshold_o)
+
+        bright_out = core.std.Lut2(clipa=bright_raw, clipb=rect, function=minimum)
+
+        bright_not = core.misc.Hysteresis(clipa=bright_out, clipb=bright_raw)
+        bright_not = core.std.Invert(bright_not)
+
+        white_txt = core.std.MaskedMerge(blank, white_raw, bright_not)
+
+        # Below 1 pixel, as when detecting at the video resolution, white_lb would be cut out by white_ub
+        lb_size = max(1, int(e)) if native else int(e)
+        white_lb = haf.mt_inpand_multi(src=white_txt, sw=lb_size, sh=lb_size, mode="ellipse")
+        white_lb = haf.mt_expand_multi(src=white_lb, sw=lb_size, sh=lb_size, mode="ellipse")
+
+        white_ub = haf.mt_inpand_multi(src=white_txt, sw=int(5 * e), sh=int(5 * e), mode="ellipse")
+        white_ub = haf.mt_expand_multi(src=white_ub, sw=int(3 * e), sh=int(3 * e), mode="ellipse")
+        white_ub = core.std.Invert(white_ub)
+
+        white = core.std.MaskedMerge(blank, white_lb, white_ub)
+        white = core.misc.Hysteresis(clipa=white, clipb=white_txt)
+
+        clip_cleaning = core.std.MaskedMerge(blank, white_raw, white)
+        clip_cleaning = core.std.Median(clip=clip_cleaning)
+
+        return clip_cleaning
+
+    def masks(self, clip):
+        """Return the blank clip and the border rectangle used to clean clip."""
+        core, vs = self.core, self.vs
+        blackclip = core.std.BlankClip(
+            width=int(clip.width - 20), height=int(clip.height - 20), format=vs.GRAY8, color=0
+        )
+        rect = core.std.AddBorders(clip=blackclip, left=10, right=10, top=10, bottom=10, color=255)
+        blank = core.std.BlankClip(clip, format=vs.GRAY8)
+        return blank, rect
+
+    def track_clips(self, clip, region, clip_native=None, ss=1):
+        """
+        Clean the box of region, returns the cleaned clip and the part of it
+        scene changes are detected on.
+
+        With clip_native, the box at the video resolution, scene changes are
+        detected on it and clip, supersampled by ss, is only cleaned for the captures.
+        """
+        thresholds = (region.white_thresh, region.black_thresh)
+        clip_cleaned = self.cleaning(clip, *self.masks(clip), self.expand_ratio, *thresholds)
+        clip_detected = clip_cleaned
+        if clip_native is not None:
+            # Morphology sizes are in supersampled pixels
+            clip_detected = self.cleaning(
+                clip_native, *self.masks(clip_native), self.expand_ratio / ss, *thresholds, native=True
+            )
+        clip_cleaned_sc = self.core.std.CropAbs(
+            clip=clip_detected,
+            width=int(clip_detected.width / 2.7), height=int(clip_detected.height / 2.7),
+            left=int(clip_detected.width * (1 - 1 / 2.7) / 2), top=int(clip_detected.height * region.detection_top)
+        )
+        return clip_cleaned, clip_cleaned_sc
+
+    def logged_track(self, clip_cleaned, clip_cleaned_sc, writer):
+        """Detect the scene changes of a cleaned track and log them with writer."""
+        core = self.core
+        clip_cleaned_sc = core.misc.SCDetect(clip=clip_cleaned_sc, threshold=self.threshold_scd)
+        clip_cleaned_sc = core.std.PlaneStats(clip_cleaned_sc)
+        if not self.props_only:
+            return core.std.FrameEval(
+                clip_cleaned,
+                functools.partial(scene_log, clip=clip_cleaned, writer=writer),
+                prop_src=[clip_cleaned_sc, clip_cleaned]
+            )
+        summary = core.std.CropAbs(clip=clip_cleaned_sc, width=1, height=1)
+        capture = core.std.ModifyFrame(
+            clip=clip_cleaned, clips=[clip_cleaned, clip_cleaned_sc],
+            selector=functools.partial(capture_scene, writer=writer)
+        )
+        capture = core.std.CropAbs(clip=capture, width=1, height=1)
+        return core.std.FrameEval(
+            summary,
+            functools.partial(select_scene_frame, summary=summary, capture=capture, writer=writer),
+            prop_src=clip_cleaned_sc
+        )
+
+    def source(self, source: str, index_path: Optional[str] = None):
+        """
+        Open the video at source, its ffms2 index is read from, or written to,
+        index_path. Raises a ValueError when a region does not fit in the video.
+        """
+        if index_path:
+            clip = self.core.ffms2.Source(source=source, cachefile=index_path)
+        else:
+            clip = self.core.ffms2.Source(source=source)
+        check_regions(self.regions, clip.width, clip.height)
+        return clip
+
+    def presence_ranges(self, source: str,
+                        index_path: Optional[str] = None) -> tuple[list[tuple[int, int]], int, float]:
+        """
+        Find the frames where a box may hold text, from the boxes decoded at
+        a PRESENCE_SCALE lower resolution and tested with NumPy thresholds.
+
+        Returns the [start, end) ranges of these frames, the frame count and
+        fps of the video. With RGB thresholds, the range is the whole video.
+        """
+        core, vs = self.core, self.vs
+        clip = self.source(source, index_path)
+        if not luma_only(self.regions):
+            return [(0, clip.num_frames)], clip.num_frames, float(clip.fps)
+
+        # Boxes are padded to the widest one to be stacked, the padding is not tested
+        max_width = max(presence_size(region)[0] for region in self.regions)
+        clip_boxes = core.std.StackVertical([
+            core.std.AddBorders(
+                core.resize.Bilinear(
+                    core.std.CropAbs(
+                        clip=clip, width=region.width, height=region.height,
+                        left=region.left(clip.width), top=region.top(clip.height)
+                    ),
+                    width=presence_size(region)[0], height=presence_size(region)[1], format=vs.GRAY8
+                ),
+                right=max_width - presence_size(region)[0]
+            ) for region in self.regions
+        ])
+
+        ranges: list[tuple[int, int]] = []
+        for n, frame in enumerate(clip_boxes.frames(close=True)):
+            if not boxes_have_text(np.asarray(frame[0]), self.regions):
+                continue
+            if ranges and ranges[-1][1] == n:
+                ranges[-1] = (ranges[-1][0], n + 1)
+            else:
+                ranges.append((n, n + 1))
+        return ranges, clip.num_frames, float(clip.fps)
+
+    def _tracks(self, source: str, output_dir: Union[Path, str], chunk_count: int, chunk_id: int,
+                index_path: Optional[str], spans: Optional[list[Chunk]],
+                native_detection: bool) -> list[tuple[Any, Any, SceneLogWriter]]:
+        """Open the video, returns the cleaned clip, detection clip and writer of every box, default first."""
+        core, vs = self.core, self.vs
+        dirs = track_dirs(
+            source, output_dir, [region.name for region in self.regions],
+            f"chunk{chunk_id}" if chunk_count > 1 or spans is not None else None
+        )
+
+        clip = self.source(source, index_path)
+        if luma_only(self.regions):
+            clip = core.std.ShufflePlanes(clips=clip, planes=0, colorfamily=vs.GRAY)
+        ss, ssbis = self.upscale_factors(clip)
+        frame_count = clip.num_frames
+        zero_pad = len(str(frame_count))
+        if spans is None and chunk_count > 1:
+            spans = [chunk_span(frame_count, chunk_count, chunk_id)]
+        if spans is not None:
+            clip = core.std.Splice([
+                core.std.Trim(clip, first=span.filter_start, last=span.filter_end - 1) for span in spans
+            ])
+
+        native = native_detection and ss != 1
+
+        def track(region, track_dir):
+            box = (region.width, region.height, region.y + region.height)
+            left = region.left(clip.width)
+            clip_region = clip
+            if luma_only([region]) and not luma_only(self.regions):
+                # The source keeps its chroma for the regions with RGB thresholds
+                clip_region = core.std.ShufflePlanes(clips=clip, planes=0, colorfamily=vs.GRAY)
+            clip_resized = self.resizing(clip_region, *box, ss, ssbis, left)
+            clip_native = self.resizing(clip_region, *box, 1, 1, left) if native else None
+            writer = SceneLogWriter(track_dir, float(clip.fps), frame_count, zero_pad, spans=spans)
+            return self.track_clips(clip_resized, region, clip_native, ss * ssbis) + (writer,)
+
+        return [track(region, track_dir) for region, track_dir in zip(self.regions, dirs)]
+
+    def build(self, source: str, output_dir: Union[Path, str],
+              chunk_count: int = 1, chunk_id: int = 0, index_path: Optional[str] = None,
+              spans: Optional[list[Chunk]] = None) -> tuple[Any, list[SceneLogWriter]]:
+        """
+        Build the graph of the video at source, the subtitle images and
+        screenlog of every region go to output_dir/<video name>/<region name>.
+        The ffms2 index of the video is read from, or written to, index_path.
+
+        With several chunks, only the frames of chunk_id and its overlap are
+        filtered, into the chunk<id> dirs of the regions, see merge_chunk_logs.
+        spans gives the frames of the chunk instead of an equal split.
+
+        Returns the output clip, every frame of which must be requested for
+        the screenlogs to be complete, and the scene log writers.
+        The output is the cleaned subtitles, or a summary with props_only.
+        """
+        # Detecting at the video resolution only pays off when the cleaned clip is not output
+        tracks = self._tracks(
+            source, output_dir, chunk_count, chunk_id, index_path, spans, self.native_detection and self.props_only
+        )
+        clips = [self.logged_track(*track) for track in tracks]
+        writers = [track[2] for track in tracks]
+        if len(clips) == 1:
+            return clips[0], writers
+        # Stacked from the last region up, the alt box above the default one
+        max_width = max(clip.width for clip in clips)
+        return self.core.std.StackVertical([
+            self.core.std.AddBorders(clip, right=max_width - clip.width) if clip.width < max_width else clip
+            for clip in reversed(clips)
+        ]), writers
+
+    def build_sampled(self, source: str, output_dir: Union[Path, str], sample_duration: float,
+                      chunk_count: int = 1, chunk_id: int = 0, index_path: Optional[str] = None,
+                      spans: Optional[list[Chunk]] = None) -> tuple[list[SampledDetection], list[SceneLogWriter]]:
+        """
+        Like build, but scene changes are detected on frames sampled every
+        sample_duration seconds, the shortest expected subtitle duration, see
+        SampledDetection. Returns the detections to run and the writers.
+        """
+        tracks = self._tracks(source, output_dir, chunk_count, chunk_id, index_path, spans, self.native_detection)
+        stride = max(1, int(sample_duration * float(tracks[0][0].fps)))
+        return [
+            SampledDetection(clip_cleaned, clip_cleaned_sc, writer, stride, self.threshold_scd)
+            for clip_cleaned, clip_cleaned_sc, writer in tracks
+        ], [track[2] for track in tracks]
+
+
+class SampledDetection:
+    """
+    Scene detection of a cleaned track on every stride-th frame.
+
+    Two samples are compared like SCDetect compares two consecutive frames.
+    When they differ, the interval between them is bisected until every
+    change is found between two consecutive frames, so the screenlog is
+    frame accurate as long as a text shown again after a change does not
+    come back within stride frames.
+    """
+
+    def __init__(self, clip_cleaned: Any, clip_cleaned_sc: Any, writer: SceneLogWriter, stride: int,
+                 threshold: float):
+        self.clip_cleaned = clip_cleaned
+        self.clip_cleaned_sc = clip_cleaned_sc
+        self.writer = writer
+        self.stride = stride
+        self.threshold = threshold
+        self.frames_read = 0
+        self._planes: dict[int, np.ndarray] = {}
+        self._maxima: dict[int, int] = {}
+        self._changes: set[int] = set()
+        self._logged = 0
+
+    def _plane(self, n: int) -> np.ndarray:
+        if n not in self._planes:
+            self._store(n, self.clip_cleaned_sc.get_frame(n))
+        return self._planes[n]
+
+    def _store(self, n: int, frame: Any) -> None:
+        plane = np.array(frame[0], dtype=np.int16)
+        self._planes[n] = plane
+        self._maxima[n] = int(plane.max())
+        self.frames_read += 1
+
+    def _changed(self, a: int, b: int) -> bool:
+        # Normalized mean absolute difference, as the PlaneStatsDiff used by SCDetect
+        return float(np.abs(self._plane(a) - self._plane(b)).mean()) / 255 > self.threshold
+
+    def _bisect(self, a: int, b: int) -> None:
+        if b - a == 1:
+            self._changes.add(b)
+            return
+        m = (a + b) // 2
+        if self._changed(a, m):
+            self._bisect(a, m)
+        if self._changed(m, b):
+            self._bisect(m, b)
+
+    def _log_until(self, end: int) -> None:
+        # A frame is logged once both of its neighbours are known
+        for n in sorted(n for n in self._maxima if self._logged <= n < end):
+            is_start, is_end = n in self._changes, n + 1 in self._changes
+            if (is_start or is_end) and self._maxima[n] > 1:
+                img = ""
+                if is_start:
+                    img = self.writer.image_name(n)
+                    save_frame(self.clip_cleaned.get_frame(n), self.writer.dir_.joinpath(img))
+                self.writer.frame_done(n, int(is_start), int(is_end), img)
+        self._logged = end
+
+    def run(self) -> None:
+        num_frames = self.clip_cleaned_sc.num_frames
+        sampled = self.clip_cleaned_sc[::self.stride]
+        previous = None
+        for idx, frame in enumerate(sampled.frames(close=True)):
+            n = idx * self.stride
+            self._store(n, frame)
+            if previous is not None and self._changed(previous, n):
+                self._bisect(previous, n)
+            self._log_until(n)
+            # Only the last sample is needed by the next comparison
+            self._planes = {n: self._planes[n]}
+            self._maxima = {k: v for k, v in self._maxima.items() if k >= n}
+            previous = n
+        if previous is not None and previous != num_frames - 1:
+            if self._changed(previous, num_frames - 1):
+                self._bisect(previous, num_frames - 1)
+        self._log_until(num_frames)
+        self.writer.finish()
+
+
+class FilterRun:
+    """
+    Run a filter graph on a thread of this process, frames are pulled
+    without any y4m output. Mimics the poll() and wait() of a vspipe Popen.
+    """
+
+    def __init__(self, subs_filter: SubsFilter, source: str, output_dir: Union[Path, str],
+                 sample_duration: float = 0., **build_args: Any):
+        """build_args are given to SubsFilter.build, or build_sampled with a sample_duration."""
+        self.error: Optional[BaseException] = None
+        self._thread = threading.Thread(
+            target=self._run, args=(subs_filter, source, output_dir, sample_duration, build_args), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, subs_filter: SubsFilter, source: str, output_dir: Union[Path, str], sample_duration: float,
+             build_args: dict[str, Any]) -> None:
+        writers = []
+        try:
+            if sample_duration > 0:
+                detections, writers = subs_filter.build_sampled(source, output_dir, sample_duration, **build_args)
+                for detection in detections:
+                    detection.run()
+            else:
+                clip, writers = subs_filter.build(source, output_dir, **build_args)
+                for _ in clip.frames(close=True):
+                    pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            for writer in writers:
+                writer.finish()
+
+    def poll(self) -> Optional[int]:
+        if self._thread.is_alive():
+            return None
+        return 1 if self.error else 0
+
+    def wait(self) -> int:
+        """Wait for the end of the filtering, raise the error it stopped on if any."""
+        self._thread.join()
+        if self.error:
+            raise self.error
+        return 0